@@ -1,123 +1,104 @@
 #!/usr/bin/python3
 
 ######
-# IGNORE THIS FILE
-# THIS IS NOT PART OF FINAL PROJECT
-# JUST A TEST PROGRAM
+# Headless runner: assembles and runs programs without the GUI
+#
+#   ./8085.py samples/random.asm --dump TABLE:100 --regs
+#   ./8085.py samples/random.asm --emit hex && ./8085.py samples/random.hex
+#
+# Files ending in .hex (Intel HEX) or .bin (flat image at --addr) are
+# loaded as prebuilt images instead of being assembled. INCLUDE files are
+# looked up next to the including file, then in each -I directory and in
+# the directories of the input files.
+#
+# Prints one JSON object per program. Exit status is the highest of:
+#   0 halted, 1 assembly error, 2 runtime error, 3 step limit, 4 timeout,
+#   5 stopped at a --break address or --watch range
 #####
 
-from ALU import ALU
-from CU import CU
-from RAM import RAM
-from Bus import Bus
-from PPI import PPI
-from threading import Thread
-from functools import partial
-import re
-import time
+from Machine import Machine
+from Batch import RunProgram, RunBatch, EmitImage, EXIT_OK, EXIT_ASSEMBLY
 
-def openFile():
-    filep = open("random.bin", "r")
-    global words
-    asm = filep.read()
-    filep.close()
-    asm = re.sub(re.compile(";.*?\n"), "", asm)
-    words = bytearray.fromhex("".join(asm.split()))
-
-def execute():
-    try:
-        cu.Run()
-    except Exception as ex:
-        print()
-        print ("Error: ")
-        print ("=======")
-        print(ex)
-        print("\tat address: " + hex(alu.registers['PC']))
-        print()
-        cu.Reset()
+import argparse
+import json
+import os
+import sys
 
 def main():
-    global bus, ram, ppi, alu, cu
-    bus = Bus()
-    ram = RAM(0x0, 64)
-    ppi = PPI(0x40)
-    bus.AddMemoryPeripheral(ram, 0x0, 0x0+64*1024-1)
-    bus.AddIOPeripheral(ppi, 0x40, 0x40+3)
-    
-    
-    alu = ALU()
-    cu = CU(alu, bus)
-    
-    ppi.SetInterruptCallPA(partial(cu.RST, 5.5, ppi))
-    ppi.SetInterruptCallPB(partial(cu.RST, 6.5, ppi))
-    
-    openFile()
-    i = 0
-    for wd in words:
-        ram.Write(0x8000+i, wd)
-        i += 1
-    
-    
-    #ram.Write(0x002C, 0x6F)
-    #ram.Write(0x002D, 0xC9)
-    ram.Write(0x002c, 0xdb)
-    ram.Write(0x002d, 0x40)
-    ram.Write(0x002e, 0xc9)
-    cu.Reset()
-    cu.SetPC(0x8000)
-    
-    thread = Thread(target=execute)
-    thread.start()
-    
-    ppi.a = 0xbb
-    while cu.running:
-        pass
-#        cmd = input("Enter a command: ")
-#        if cmd == "quit":
-#            cu.running = False
-#        elif cmd == "stba":
-#            ppi.StrobeA()
-#        elif cmd == "stbb":
-#            ppi.StrobeB()
-#        elif cmd == "show":
-#            print("")
-#            alu.Show()
-#            #print("\n")
-#            #ram.Show()
-#            print("\n")
-#            ppi.Show()
-
-    ram.ShowRange(parser.labels["TABLE"], parser.labels["TABLE"]+0x63)
-    alu.Show()
+    parser = argparse.ArgumentParser(description="Assemble and run 8085 programs without the GUI.")
+    parser.add_argument("files", nargs='+', help="assembly source files, each run on a fresh machine")
+    parser.add_argument("--addr", type=lambda x: int(x, 16), default=0x8000, help="load address in hex (default 8000)")
+    parser.add_argument("--start", help="start address in hex or a label (default: load address)")
+    parser.add_argument("--max-steps", type=int, default=None, help="stop after this many instructions")
+    parser.add_argument("--timeout", type=float, default=None, help="stop after this many seconds")
+    parser.add_argument("--dump", action='append', default=[], metavar="ADDR[:LEN]",
+                        help="dump LEN (decimal) bytes from ADDR, a hex address or a label")
+    parser.add_argument("--break", dest="breakpoints", action='append', default=[], metavar="ADDR",
+                        help="stop before running the instruction at ADDR, a hex address or a label")
+    parser.add_argument("--watch", action='append', default=[], metavar="ADDR[:LEN[:ACCESS]]",
+                        help="stop after an instruction reads (r) or writes (w) memory in this range")
+    parser.add_argument("--watch-log", action='append', default=[], metavar="ADDR[:LEN[:ACCESS]]",
+                        help="list accesses to this range in the result without stopping")
+    parser.add_argument("--trace", action='store_true',
+                        help="record every instruction to a .trace file next to the source (read it with Trace.py)")
+    parser.add_argument("--regs", action='store_true', help="dump registers")
+    parser.add_argument("--labels", action='store_true', help="dump labels")
+    parser.add_argument("--ppi", action='append', default=[], metavar="ADDR", help="attach an 8255 PPI at IO address ADDR (hex)")
+    parser.add_argument("--no-blocks", action='store_true', help="run instruction by instruction instead of by translated blocks")
+    parser.add_argument("--clock", type=float, default=None, metavar="HZ",
+                        help="pace execution to this clock rate, e.g. 3e6 (default: unthrottled)")
+    parser.add_argument("--emit", choices=[ "hex", "bin" ],
+                        help="write each program as an Intel HEX or flat binary image next to its source instead of running it")
+    parser.add_argument("-I", dest="include", action='append', default=[], metavar="DIR",
+                        help="search DIR for INCLUDE files")
+    parser.add_argument("--jobs", type=int, default=1, help="run files in this many worker processes")
+    args = parser.parse_args()
 
+    includePath = args.include + sorted(set(os.path.dirname(os.path.abspath(f)) for f in args.files))
+    options = { "start":args.start, "maxSteps":args.max_steps, "timeout":args.timeout, "dumps":args.dump,
+                "regs":args.regs, "labels":args.labels, "blockMode":not args.no_blocks,
+                "clockRate":args.clock, "includePath":includePath, "breakpoints":args.breakpoints,
+                "watches":args.watch, "watchLogs":args.watch_log }
+    inputs = { "ppi":{ int(addr, 16):{} for addr in args.ppi } }
 
-from Assembler import Assembler
-parser = Assembler()
-try:
-    #main()
-    filep = open("samples/testlbl.asm", "r")
-    asm = filep.read()
-    filep.close()
-    parser.Lex(asm)
-    parser.Parse()
-    
-    #filep = open("random.bin", "w")
-    for bytes in parser.bytes_list:
-        print(hex(bytes["address"]))
-        for byte in bytes["bytes"]:
-            print(hex(byte))
-    #    filep.write('{0:02x}'.format(byte) + "\n")
-    #filep.close()
+    exitCode = EXIT_OK
+    jobs = []
+    for filename in args.files:
+        try:
+            if os.path.splitext(filename)[1].lower() in (".hex", ".bin"):
+                with open(filename, 'rb') as fp:
+                    jobs.append((filename, (fp.read(), args.addr, inputs)))
+            else:
+                with open(filename, 'r') as fp:
+                    jobs.append((filename, (fp.read(), args.addr, inputs)))
+        except IOError as ex:
+            print(json.dumps({ "file":filename, "status":"assembly-error", "error":str(ex) }))
+            exitCode = EXIT_ASSEMBLY
 
-    #main()
+    if args.emit:
+        for filename, job in jobs:
+            output = os.path.splitext(filename)[0] + "." + args.emit
+            try:
+                EmitImage(job[0], output, args.addr, args.emit, includePath)
+                print(json.dumps({ "file":filename, "status":"assembled", "output":output }))
+            except Exception as ex:
+                print(json.dumps({ "file":filename, "status":"assembly-error", "error":str(ex) }))
+                exitCode = EXIT_ASSEMBLY
+        return exitCode
 
-except (KeyboardInterrupt, SystemExit):
-    print("")
+    jobOptions = [ { "trace":os.path.splitext(filename)[0] + ".trace" } if args.trace else {} for filename, job in jobs ]
+    if args.jobs > 1:
+        results = RunBatch([ job for filename, job in jobs ], args.jobs, jobOptions, **options)
+        for index, result, code in results:
+            print(json.dumps(dict(file=jobs[index][0], **result)), flush=True)
+            exitCode = max(exitCode, code)
+    else:
+        machine = Machine()
+        for (filename, job), extra in zip(jobs, jobOptions):
+            result, code = RunProgram(machine, *job, **dict(options, **extra))
+            print(json.dumps(dict(file=filename, **result)), flush=True)
+            exitCode = max(exitCode, code)
+    return exitCode
 
-except Exception as ex:
-    print()
-    print ("Error: ")
-    print ("=======")
-    print(ex)
-    print("at line: \n\t" + parser.line + "\nline no.: " + str(parser.line_no))
-    print()
+if __name__ == "__main__":
+    sys.exit(main())
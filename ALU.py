@@ -1,260 +1,340 @@
+from array import array
+
 regPair = { 'H':'L', 'B':'C', 'D':'E', 'A':'F' }
 
+flag_cy = 0x01
+flag_p = 0x04
+flag_ac = 0x10
+flag_z = 0x40
+flag_s = 0x80
+
+def BuildSZPTable():
+    table = bytearray(256)
+    for val in range(256):
+        flags = val & flag_s
+        if val == 0:
+            flags |= flag_z
+        if bin(val).count('1') % 2 == 0:
+            flags |= flag_p
+        table[val] = flags
+    return table
+
+# add_table[(carry << 16) | (a << 8) | b] holds (flags << 8) | result of a+b+carry,
+# sub_table the same for a-b-borrow
+def BuildArithmeticTables():
+    add_table = array('H', bytes(2*0x20000))
+    sub_table = array('H', bytes(2*0x20000))
+    for c in (0, 1):
+        for a in range(256):
+            base = (c << 16) | (a << 8)
+            lowA = a & 0x0F
+            for b in range(256):
+                res = a + b + c
+                flags = szp_table[res & 0xFF]
+                if res > 0xFF:
+                    flags |= flag_cy
+                if lowA + (b & 0x0F) + c > 0x0F:
+                    flags |= flag_ac
+                add_table[base | b] = (flags << 8) | (res & 0xFF)
+
+                res = a - b - c
+                flags = szp_table[res & 0xFF]
+                if res < 0:
+                    flags |= flag_cy
+                if lowA - (b & 0x0F) - c < 0:
+                    flags |= flag_ac
+                sub_table[base | b] = (flags << 8) | (res & 0xFF)
+    return add_table, sub_table
+
+szp_table = BuildSZPTable()
+add_table, sub_table = BuildArithmeticTables()
+
+class Registers:
+    __slots__ = ( 'A', 'B', 'C', 'D', 'E', 'H', 'L', 'F', 'PC', 'SP' )
+
+    def __init__(self):
+        self.Reset()
+
+    def Reset(self):
+        self.A = 0
+        self.B = 0
+        self.C = 0
+        self.D = 0
+        self.E = 0
+        self.H = 0
+        self.L = 0
+        self.F = 0
+        self.PC = 0
+        self.SP = 0xFF
+
+    def __getitem__(self, reg):
+        if not reg in self.__slots__:
+            raise KeyError(reg)
+        return getattr(self, reg)
+
+    def __setitem__(self, reg, val):
+        if not reg in self.__slots__:
+            raise KeyError(reg)
+        setattr(self, reg, val)
+
+    def __contains__(self, reg):
+        return reg in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def values(self):
+        return [ getattr(self, k) for k in self.__slots__ ]
+
+    def items(self):
+        return [ (k, getattr(self, k)) for k in self.__slots__ ]
+
+    @property
+    def BC(self):
+        return (self.B << 8) | self.C
+
+    @BC.setter
+    def BC(self, val):
+        self.B = (val >> 8) & 0xFF
+        self.C = val & 0xFF
+
+    @property
+    def DE(self):
+        return (self.D << 8) | self.E
+
+    @DE.setter
+    def DE(self, val):
+        self.D = (val >> 8) & 0xFF
+        self.E = val & 0xFF
+
+    @property
+    def HL(self):
+        return (self.H << 8) | self.L
+
+    @HL.setter
+    def HL(self, val):
+        self.H = (val >> 8) & 0xFF
+        self.L = val & 0xFF
+
+    @property
+    def PSW(self):
+        return (self.A << 8) | self.F
+
+    @PSW.setter
+    def PSW(self, val):
+        self.A = (val >> 8) & 0xFF
+        self.F = val & 0xFF
+
+
 class ALU:
     def __init__(self):
-        self.registers = { 'A':0, 'B':0, 'C':0, 'D':0, 'E':0, 'H':0, 'L':0, 'F':0, 'PC':0, 'SP':0xFF }
+        self.registers = Registers()
         self.CheckAll()
 
     def Reset(self):
-        self.registers = { 'A':0, 'B':0, 'C':0, 'D':0, 'E':0, 'H':0, 'L':0, 'F':0, 'PC':0, 'SP':0xFF }
+        self.registers.Reset()
         self.CheckAll()
 
     def SetCarry(self, toSet=True):
         if toSet:
-            self.registers['F'] |= 0x01
+            self.registers.F |= flag_cy
         else:
-            self.registers['F'] &= ~0x01
+            self.registers.F &= ~flag_cy
 
     def SetAuxCarry(self, toSet=True):
         if toSet:
-            self.registers['F'] |= 0x08
+            self.registers.F |= flag_ac
         else:
-            self.registers['F'] &= ~0x08
+            self.registers.F &= ~flag_ac
 
     def SetZero(self, toSet=True):
         if toSet:
-            self.registers['F'] |= 0x40
+            self.registers.F |= flag_z
         else:
-            self.registers['F'] &= ~0x40
+            self.registers.F &= ~flag_z
 
     def SetSign(self, toSet=True):
         if toSet:
-            self.registers['F'] |= 0x80
+            self.registers.F |= flag_s
         else:
-            self.registers['F'] &= ~0x80
+            self.registers.F &= ~flag_s
 
     def SetParity(self, toSet=True):
         if toSet:
-            self.registers['F'] |= 0x04
+            self.registers.F |= flag_p
         else:
-            self.registers['F'] &= ~0x04
+            self.registers.F &= ~flag_p
     
     def GetCarry(self):
-        return self.registers['F'] & 0x01 == 0x01
+        return self.registers.F & flag_cy == flag_cy
 
     def GetAuxCarry(self):
-        return self.registers['F'] & 0x08 == 0x08
+        return self.registers.F & flag_ac == flag_ac
 
     def GetZero(self):
-        return self.registers['F'] & 0x40 == 0x40
+        return self.registers.F & flag_z == flag_z
 
     def GetSign(self):
-        return self.registers['F'] & 0x80 == 0x80
+        return self.registers.F & flag_s == flag_s
 
     def GetParity(self):
-        return self.registers['F'] & 0x04 == 0x04
-
+        return self.registers.F & flag_p == flag_p
 
-    def CheckForCarry(self, reg='A'):
-        self.SetCarry(self.registers[reg] > 0xFF)
-        if self.registers[reg] > 0xFF:
-            self.registers[reg] -= 0xFF + 0x01
-    
-    def CheckForBurrow(self, reg='A'):
-        self.SetCarry(self.registers[reg] < 0x00)
-        if self.registers[reg] < 0x00:
-            self.registers[reg] += 0xFF + 0x1
-
-    def CheckForZero(self, val=0xFFFFFFF):
-        if val == 0xFFFFFFF:
-            val = self.registers['A']
-        self.SetZero(val==0)
-    
-    def CheckForSign(self, val=0xFFFFFFF):
+    def CheckAll(self, val=0xFFFFFFF):
         if val == 0xFFFFFFF:
-            val = self.registers['A']
-        self.SetSign(val & 0x80 == 0x80)
+            val = self.registers.A
+        self.registers.F = (self.registers.F & ~(flag_s | flag_z | flag_p)) | szp_table[val & 0xFF]
 
-    def CheckForParity(self, val=0xFFFFFFF):
-        if val == 0xFFFFFFF:
-            val = self.registers['A']
-        p = 0
-        while val:
-            p = ~p
-            val = val & (val - 1)
-        self.SetParity(p==0)
+    def Increment(self, val):
+        res = add_table[(val << 8) | 1]
+        self.registers.F = (self.registers.F & flag_cy) | ((res >> 8) & ~flag_cy)
+        return res & 0xFF
 
+    def Decrement(self, val):
+        res = sub_table[(val << 8) | 1]
+        self.registers.F = (self.registers.F & flag_cy) | ((res >> 8) & ~flag_cy)
+        return res & 0xFF
 
-    def CheckAll(self, val=0xFFFFFFF):
-        self.CheckForZero(val)
-        self.CheckForSign(val)
-        self.CheckForParity(val)
-    
     def Inr(self, reg):
-        self.registers[reg] += 1
-        self.CheckForCarry(reg)
-        self.CheckAll(self.registers[reg])
+        setattr(self.registers, reg, self.Increment(getattr(self.registers, reg)))
+
+    def Dcr(self, reg):
+        setattr(self.registers, reg, self.Decrement(getattr(self.registers, reg)))
 
     def Inx(self, reg):
+        r = self.registers
+        if reg == 'SP':
+            r.SP = (r.SP + 1) & 0xFFFF
+            return
         reg2 = regPair[reg]
-        if self.registers[reg2] == 0xFF:
-            self.registers[reg2] = 0
-            if self.registers[reg] == 0xFF:
-                self.registers[reg] = 0
-                self.SetCarry()
-            else:
-                self.registers[reg] += 1
-                self.SetCarry(False)
-        else:
-            self.registers[reg2] += 1
-            self.SetCarry(False)
-        self.CheckAll((self.registers[reg]<<8) | self.registers[reg2])           
-
-    def Add(self, val, carry=False):
-        res = self.registers['A'] + val
-        if carry:
-            c = self.registers['F'] & 0x01
-            res += c
-        self.registers['A'] = res
-        self.CheckForCarry()
-        self.CheckAll()
-     
-    def Dcr(self, reg):
-        self.registers[reg] -= 1
-        self.CheckForBurrow(reg)
-        self.CheckAll(self.registers[reg])           
+        val = ((getattr(r, reg) << 8) | getattr(r, reg2)) + 1
+        setattr(r, reg, (val >> 8) & 0xFF)
+        setattr(r, reg2, val & 0xFF)
 
     def Dcx(self, reg):
+        r = self.registers
+        if reg == 'SP':
+            r.SP = (r.SP - 1) & 0xFFFF
+            return
         reg2 = regPair[reg]
-        if self.registers[reg2] == 0:
-            self.registers[reg2] = 0xFF
-            if self.registers[reg] == 0:
-                self.registers[reg] = 0xFF
-                self.SetCarry()
-            else:
-                self.registers[reg] -= 1
-                self.SetCarry(False)
-        else:
-            self.registers[reg2] -= 1
-            self.SetCarry(False)
-        self.CheckAll((self.registers[reg]<<8) | self.registers[reg2])           
+        val = ((getattr(r, reg) << 8) | getattr(r, reg2)) - 1
+        setattr(r, reg, (val >> 8) & 0xFF)
+        setattr(r, reg2, val & 0xFF)
+
+    def Add(self, val, carry=False):
+        r = self.registers
+        c = r.F & flag_cy if carry else 0
+        res = add_table[(c << 16) | (r.A << 8) | val]
+        r.A = res & 0xFF
+        r.F = res >> 8
 
     def Sub(self, val, burrow=False):
-        res = self.registers['A'] - val
-        if (burrow):
-            c = self.registers['F'] & 0x01
-            res -= c
-        self.registers['A'] = res
-        self.CheckForBurrow()
-        self.CheckAll()
+        r = self.registers
+        c = r.F & flag_cy if burrow else 0
+        res = sub_table[(c << 16) | (r.A << 8) | val]
+        r.A = res & 0xFF
+        r.F = res >> 8
 
     def And(self, val):
-        self.registers['A'] &= val
-        self.CheckAll()
+        r = self.registers
+        r.A &= val
+        r.F = szp_table[r.A] | flag_ac
 
     def Or(self, val):
-        self.registers['A'] |= val
-        self.CheckAll()
+        r = self.registers
+        r.A |= val
+        r.F = szp_table[r.A]
 
     def Xor(self, val):
-        self.registers['A'] ^= val
-        self.CheckAll()
+        r = self.registers
+        r.A ^= val
+        r.F = szp_table[r.A]
 
     def Not(self):
-        self.Xor(0xFF)
-        self.CheckAll()
+        self.registers.A ^= 0xFF
 
     def Compare(self, val):
-        temp = self.registers['A']
-        self.Sub(val)
-        self.registers['A'] = temp
+        r = self.registers
+        r.F = sub_table[(r.A << 8) | val] >> 8
 
     def DecimalAdjust(self):
-        #TODO
-        pass
+        r = self.registers
+        a = r.A
+        carry = r.F & flag_cy
+        corr = 0
+        if r.F & flag_ac or (a & 0x0F) > 0x09:
+            corr |= 0x06
+        if carry or a > 0x99:
+            corr |= 0x60
+            carry = flag_cy
+        res = add_table[(a << 8) | corr]
+        r.A = res & 0xFF
+        r.F = ((res >> 8) & ~flag_cy) | carry
 
     def DoubleAddition(self, val):
-        c = 0x00
-        self.registers['L'] += val & 0xFF
-        if self.registers['L'] > 0xFF:
-            self.registers['L'] -= 0xFF + 0x01
-            c = 0x01
-        val = val >> 8
-        self.registers['H'] += val + c
-        self.SetCarry(self.registers['H'] > 0xFF)
-        if self.registers['H'] > 0xFF:
-            self.registers['H'] -= 0xFF + 0x01
-        self.CheckAll(self.GetHL())
+        r = self.registers
+        res = ((r.H << 8) | r.L) + val
+        r.H = (res >> 8) & 0xFF
+        r.L = res & 0xFF
+        self.SetCarry(res > 0xFFFF)
 
     def Rlc(self):
-        a = self.registers['A']
-        bit = a & 0x80
-        a <<= 1
-        if bit != 0:
-            a |= 1
-            self.SetCarry()
-        a &= 0xFF
-        self.registers['A'] = a
+        a = self.registers.A
+        bit = a >> 7
+        self.registers.A = ((a << 1) | bit) & 0xFF
+        self.SetCarry(bit)
 
     def Rrc(self):
-        a = self.registers['A']
+        a = self.registers.A
         bit = a & 0x01
-        a >>= 1
-        if bit != 0:
-            a |= 0x80
-            self.SetCarry()
-        a &= 0xFF
-        self.registers['A'] = a
+        self.registers.A = (a >> 1) | (bit << 7)
+        self.SetCarry(bit)
     
     def Ral(self):
-        a = self.registers['A']
-        bit = a & 0x80
-        a <<= 1
-        if self.GetCarry():
-            a |= 1;
-        if bit != 0:
-            self.SetCarry()
-        a &= 0xFF
-        self.registers['A'] = a
+        a = self.registers.A
+        bit = a >> 7
+        self.registers.A = ((a << 1) | (self.registers.F & flag_cy)) & 0xFF
+        self.SetCarry(bit)
 
     def Rar(self):
-        a = self.registers['A']
+        a = self.registers.A
         bit = a & 0x01
-        a >>= 1
-        if self.GetCarry():
-            a |= 0x80
-        if bit != 0:
-            self.SetCarry()
-        a &= 0xFF
-        self.registers['A'] = a
+        self.registers.A = (a >> 1) | ((self.registers.F & flag_cy) << 7)
+        self.SetCarry(bit)
     
     def GetBC(self):
-        return (self.registers['B'] << 8) | self.registers['C']
+        return (self.registers.B << 8) | self.registers.C
 
     def GetDE(self):
-        return (self.registers['D'] << 8) | self.registers['E']
+        return (self.registers.D << 8) | self.registers.E
    
     def GetHL(self):
-        return (self.registers['H'] << 8) | self.registers['L']
+        return (self.registers.H << 8) | self.registers.L
     
     def GetPSW(self):
-        return (self.registers['A'] << 8) | self.registers['F']
+        return (self.registers.A << 8) | self.registers.F
 
     def SetBC(self, val):
-        self.registers['C'] = val & 0xFF
-        self.registers['B'] = (val >> 8)
+        self.registers.C = val & 0xFF
+        self.registers.B = (val >> 8)
 
     def SetDE(self, val):
-        self.registers['E'] = val & 0xFF
-        self.registers['D'] = (val >> 8)
+        self.registers.E = val & 0xFF
+        self.registers.D = (val >> 8)
 
     def SetHL(self, val):
-        self.registers['L'] = val & 0xFF
-        self.registers['H'] = (val >> 8)
+        self.registers.L = val & 0xFF
+        self.registers.H = (val >> 8)
 
     def SetAF(self, val):
-        self.registers['F'] = val & 0xFF
-        self.registers['A'] = (val >> 8)
+        self.registers.F = val & 0xFF
+        self.registers.A = (val >> 8)
 
 
     def Show(self):
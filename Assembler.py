@@ -1,5 +1,9 @@
 
 import re
+import os
+from array import array
+from bisect import bisect_right
+from Loader import WriteHex, WriteBinary
 
 regOffset = [ 'B', 'C', 'D', 'E', 'H', 'L', 'M', 'A' ]
 regPair = { 'H':'L', 'B':'C', 'D':'E', 'A':'F' }
@@ -10,7 +14,7 @@ mov_map = { 'A':0x78, 'B':0x40, 'C':0x48, 'D':0x50, 'E':0x58, 'H':0x60, 'L':0x68
 push_map = { 'B':0xC5, 'D':0xD5, 'H':0xE5, 'PSW':0xF5 }
 pop_map = { 'B':0xC1, 'D':0xD1, 'H':0xE1, 'PSW':0xF1 }
 rst_map = [ 0xC7, 0xCF, 0xD7, 0xDF, 0xE7, 0xEF, 0xF7, 0xFF ]
-cnd_map = { 'NZ':0xC2, 'Z':0xCA, 'NC':0xD2, 'C':0xDA, 'PO':0xE2, 'P':0xF2, 'M':0xFA }
+cnd_map = { 'NZ':0xC2, 'Z':0xCA, 'NC':0xD2, 'C':0xDA, 'PO':0xE2, 'PE':0xEA, 'P':0xF2, 'M':0xFA }
 
 ins_len2 = [ 'MVI', 'ADI', 'ACI', 'SUI', 'SBI', 'ANI', 'XRI', 'ORI', 'CPI',
              'OUT', 'IN' ]
@@ -23,11 +27,39 @@ imm_opcodes = { 'ADI':0xC6, 'ACI':0xCE, 'SUI':0xD6, 'SBI':0xDE, 'ANI':0xE6, 'XRI
 addr_opcodes = { 'LDA': 0x3A, 'STA':0x32, 'JMP':0xC3, 'CALL':0xCD }
 
 singlebytereg_opcodes = { 'ADD':0x80, 'ADC':0x88, 'SUB':0x90, 'SBB':0x98, 'ANA':0xA0, 'XRA':0xA8, 'ORA':0xB0, 'CMP':0xB8 } 
-singlebyte_opcodes = { 'RET':0xC9, 'HLT':0x76, 'RLC':0x07, 'RRC':0x0F, 'RAL':0x17, 'RAR':0x1F, 'CMA':0x2E, 'DDA':0x27, 'CMC':0x3F,
-                        'STC':0x37, 'EI':0xFB, 'DI':0xFB, 'NOP':0x00, 'XTHL':0xE3, 'SPHL':0xF9, 'SIM':0x30, 'RIM':0x20, 'XCHG':0xEB }
+singlebyte_opcodes = { 'RET':0xC9, 'HLT':0x76, 'RLC':0x07, 'RRC':0x0F, 'RAL':0x17, 'RAR':0x1F, 'CMA':0x2F, 'DAA':0x27, 'CMC':0x3F,
+                        'STC':0x37, 'EI':0xFB, 'DI':0xF3, 'NOP':0x00, 'XTHL':0xE3, 'SPHL':0xF9, 'SIM':0x30, 'RIM':0x20, 'XCHG':0xEB }
 
 misc_opcodes = [ 'MOV', 'INX', 'DCX', 'INR', 'DCR', 'PUSH', 'POP', 'DAD', 'RST' ]
 
+directives = [ 'ORG', 'DB', 'DW', 'DS', 'EQU' ]
+
+comment_re = re.compile(r"^((?:[^;\"']|\"[^\"]*\"|'[^']*')*);.*$")
+token_re = re.compile(r"\s*(\"[^\"]*\"|'[^']*'|\w+|\S)")
+head_re = re.compile(r"^\s*(?:(\w+)\s*:)?\s*(\w+)?\s*(\w+)?(.*)$")
+expand_re = re.compile(r"\b(?:MACRO|INCLUDE)\b", re.IGNORECASE)
+include_re = re.compile(r"^\s*INCLUDE\s+(\"[^\"]*\"|'[^']*')\s*$", re.IGNORECASE)
+
+max_expansion_depth = 16
+
+# path -> (mtime, size, lines); lines are (text, file, line_no, shared) tuples
+include_cache = {}
+# Lex results for lines read from include files, shared by every Assembler
+include_lex_cache = {}
+
+def ReadInclude(path):
+    st = os.stat(path)
+    cached = include_cache.get(path)
+    if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    if cached is not None:
+        include_lex_cache.clear()
+    with open(path, 'r') as fp:
+        text = fp.read()
+    lines = [ (line, path, i+1, True) for i, line in enumerate(text.split('\n')) ]
+    include_cache[path] = (st.st_mtime_ns, st.st_size, lines)
+    return lines
+
 def is_hex(s):
     try:
         int(s, 16)
@@ -37,10 +69,27 @@ def is_hex(s):
 
 class Assembler:
     
-    def __init__(self):
+    def __init__(self, lineCache=None, encodingCache=None, includePath=()):
         self.asm = []
+        self.includePath = list(includePath)
+        self.includes = {}
+        self.macros = {}
+        self.file = None
         self.bytes_list = []
         self.labels = {}
+        self.lineCache = lineCache
+        self.encodingCache = encodingCache
+        # Per source line: first statement index, label defined, label still pending after it
+        self.lineStmts = []
+        self.lineLabels = []
+        self.carry = []
+        self.labelLines = {}
+        # Per statement: layout address; per label: statements whose encoding
+        # uses it, and the labels ORG, EQU or DS take a value from
+        self.addresses = []
+        self.refs = {}
+        self.layoutLabels = set()
+        self.index = None
 
     def IsIns(self, opcode):
         if opcode in ins_len2:
@@ -53,6 +102,8 @@ class Assembler:
             return True
         elif opcode in misc_opcodes:
             return True
+        elif opcode in directives:
+            return True
         return False
 
     def GetInsLen(self, opcode):
@@ -62,69 +113,336 @@ class Assembler:
             return 3
         return 1
 
+    def LexLine(self, line):
+        tokens = token_re.findall(line)
+        label = ""
+        if len(tokens) >= 2 and tokens[1] == ':':
+            label = tokens[0].upper()
+            if self.IsIns(label):
+                raise Exception("Invalid label: "+ label)
+            tokens = tokens[2:]
+        if len(tokens) >= 2 and tokens[1].upper() == 'EQU':
+            # NAME EQU value, without a colon
+            tokens = [ tokens[1], tokens[0] ] + tokens[2:]
+        elif label != "" and len(tokens) >= 1 and tokens[0].upper() == 'EQU':
+            tokens = [ tokens[0], label ] + tokens[1:]
+            label = ""
+        if len(tokens) == 0:
+            return label, None
+        s = {}
+        s["opcode"] = tokens[0].upper()
+        if s["opcode"] in directives:
+            return label, self.LexDirective(s, tokens, line)
+        s["op1"] = None
+        s["op2"] = None
+        s["type"] = "ASM"
+        if is_hex(s["opcode"]) and not self.IsIns(s["opcode"]):
+            s["type"] = "HEX"
+            s["data"] = []
+            for t in tokens:
+                s["data"].append(int(t,16))
+        elif len(tokens) > 1:
+            s["op1"] = tokens[1].upper()
+            if len(tokens) > 2:
+                if len(tokens) < 4 or tokens[2] != ",":
+                    raise Exception("Error: expected operand separated by comma\n\t"+line)
+                s["op2"] = tokens[3].upper()
+        return label, s
+
+    def LexDirective(self, s, tokens, line):
+        s["type"] = "DIR"
+        s["op1"] = None
+        s["op2"] = None
+        args = []
+        if s["opcode"] == 'EQU':
+            s["name"] = tokens[1].upper()
+            if self.IsIns(s["name"]) or is_hex(s["name"]):
+                raise Exception("Invalid label: " + s["name"])
+            tokens = tokens[1:]
+        for i, t in enumerate(tokens[1:]):
+            if (i % 2 == 1) != (t == ","):
+                raise Exception("Error: expected operands separated by comma\n\t" + line)
+            if t != ",":
+                args.append(t if t[0] in "\"'" else t.upper())
+        if not args or tokens[-1] == ",":
+            raise Exception("Error: missing operand for " + s["opcode"] + "\n\t" + line)
+        if s["opcode"] in ('ORG', 'EQU') and len(args) != 1 or s["opcode"] == 'DS' and len(args) > 2:
+            raise Exception("Error: wrong number of operands for " + s["opcode"] + "\n\t" + line)
+        s["args"] = args
+        if s["opcode"] == 'DB':
+            s["size"] = sum(len(a)-2 if a[0] in "\"'" else 1 for a in args)
+        elif s["opcode"] == 'DW':
+            s["size"] = 2 * len(args)
+        return s
+
     def Lex(self, asmString):
-        asms = asmString.split('\n')
-        lastLabel = ""
-        lineno = 0
-        for asm in asms:
-            lineno += 1
-            line = re.sub(re.compile(";.*$"), "", asm)
+        self.labelLines = {}
+        self.asm, self.lineStmts, self.lineLabels, self.carry = self.LexLines(self.Expand(asmString), "", 0)
+        return True
+
+    def Expand(self, asmString):
+        # Returns the source as (text, file, line_no, shared) lines with
+        # INCLUDE files and MACRO invocations expanded in place
+        self.macros = {}
+        self.includes = {}
+        self.expansions = 0
+        lines = [ (line, None, i+1, False) for i, line in enumerate(asmString.split('\n')) ]
+        if not expand_re.search(asmString):
+            return lines
+        return self.ExpandLines(lines, 0, [])
+
+    def ExpandLines(self, lines, depth, stack):
+        out = []
+        i = 0
+        while i < len(lines):
+            text, file, line_no, shared = lines[i]
+            i += 1
+            head = head_re.match(text)
+            word = (head.group(2) or "").upper()
+            if (head.group(3) or "").upper() == 'MACRO' and not head.group(1):
+                self.SetOrigin(text, file, line_no)
+                name = word
+                if self.IsIns(name) or name in ('INCLUDE', 'MACRO', 'ENDM'):
+                    raise Exception("Invalid macro name: " + name)
+                params = [ p.strip().upper() for p in comment_re.sub(r"\1", head.group(4)).split(',') if p.strip() ]
+                body = []
+                while True:
+                    if i >= len(lines):
+                        self.SetOrigin(text, file, line_no)
+                        raise Exception("Error: MACRO " + name + " without ENDM")
+                    if (head_re.match(lines[i][0]).group(2) or "").upper() == 'ENDM':
+                        break
+                    body.append(lines[i])
+                    i += 1
+                i += 1
+                self.macros[name] = (params, body)
+            elif word == 'INCLUDE':
+                self.SetOrigin(text, file, line_no)
+                match = include_re.match(comment_re.sub(r"\1", text))
+                if not match:
+                    raise Exception("Error: expected INCLUDE \"file\"\n\t" + text)
+                path = self.FindInclude(match.group(1)[1:-1], file)
+                if path in stack or depth >= max_expansion_depth:
+                    raise Exception("Error: recursive INCLUDE of " + path)
+                included = ReadInclude(path)
+                self.includes[path] = include_cache[path][:2]
+                out += self.ExpandLines(included, depth+1, stack + [ path ])
+            elif word in self.macros:
+                self.SetOrigin(text, file, line_no)
+                if depth >= max_expansion_depth:
+                    raise Exception("Error: macro expansion too deep: " + word)
+                out += self.ExpandMacro(word, head.group(1), text[head.end(2):], depth, stack)
+            else:
+                out.append(lines[i-1])
+        return out
+
+    def ExpandMacro(self, name, label, rest, depth, stack):
+        params, body = self.macros[name]
+        rest = rest or ""
+        args = [ a.strip() for a in comment_re.sub(r"\1", rest).split(',') ] if rest.strip() else []
+        if len(args) != len(params):
+            raise Exception("Error: " + name + " expects " + str(len(params)) + " arguments")
+        self.expansions += 1
+        subst = dict(zip(params, args))
+        pattern = re.compile(r"\b(" + "|".join(re.escape(p) for p in params) + r")\b", re.IGNORECASE) if params else None
+        lines = []
+        for text, file, line_no, shared in body:
+            if pattern:
+                text = pattern.sub(lambda m: subst[m.group(1).upper()], text)
+            text = text.replace("@@", str(self.expansions))
+            lines.append((text, file, line_no, False))
+        if label:
+            # The invocation's label names the first expanded line
+            if lines and not head_re.match(lines[0][0]).group(1):
+                text, file, line_no, shared = lines[0]
+                lines[0] = (label + ": " + text, file, line_no, shared)
+            else:
+                lines.insert(0, (label + ":",) + (lines[0][1:] if lines else (None, 0, False)))
+        return self.ExpandLines(lines, depth+1, stack)
+
+    def FindInclude(self, name, file):
+        dirs = [ os.path.dirname(file) if file else os.getcwd() ] + self.includePath
+        for d in dirs:
+            path = os.path.abspath(os.path.join(d, name))
+            if os.path.isfile(path):
+                return path
+        raise Exception("Error: include file not found: " + name)
+
+    def SetOrigin(self, text, file, line_no):
+        self.line = text
+        self.file = file
+        self.line_no = line_no
+
+    def LexLines(self, lines, lastLabel, k, later=None):
+        # Lexes (text, file, line_no, shared) lines from Expand into statements
+        # numbered from k. Returns the statements and, per line, the first
+        # statement index, the label defined and the label still pending after it.
+        # later is set when these lines are lexed again after an edit, see
+        # DuplicateLabel
+        stmts = []
+        lineStmts = []
+        lineLabels = []
+        carry = []
+        for text, file, lineno, shared in lines:
             self.line_no = lineno
+            self.file = file
+            cache = include_lex_cache if shared else self.lineCache
+            lexed = cache.get(text) if cache is not None else None
+            if lexed is None:
+                line = comment_re.sub(r"\1", text)
+                self.line = line
+                lexed = (line,) + self.LexLine(line)
+                if cache is not None:
+                    cache[text] = lexed
+            line, label, fields = lexed
             self.line = line
-            s = {}
-            tokens = re.findall("\s*(\w+|.)", line)
-            tokens = [ t for t in tokens if t.strip() ]
-            if len(tokens) >= 2 and tokens[1] == ':':
-                lastLabel = tokens[0].upper()
-                if self.IsIns(lastLabel):
-                    raise Exception("Invalid label: "+ lastLabel)
-                tokens = tokens[2:]
-                for x in self.asm:
-                    if lastLabel == x["label"]:
-                        lastLabel = ""
-                        raise Exception("Error: duplicate label name, previously defined at:\n\t"+x["line"]) 
-                        break
-            if len(tokens) == 0:
+            lineStmts.append(k + len(stmts))
+            name = fields["name"] if fields is not None and "name" in fields else label
+            lineLabels.append(name)
+            if name != "":
+                if name in self.labelLines:
+                    self.DuplicateLabel(name, line, later)
+                self.labelLines[name] = line
+            if label != "":
+                lastLabel = label
+            if fields is None:
                 if lastLabel != "":
                     s = {}
                     s["data"] = [ 0 ]
                     s["opcode"] = "00"
                     s["type"] = "HEX"
                     s["line_no"] = lineno
+                    s["file"] = file
                     s["line"] = line
                     s["label"] = lastLabel
-                    self.asm.append(s)
-                continue
-            s["opcode"] = tokens[0].upper()
-            s["op1"] = None
-            s["op2"] = None
-            s["line"] = line
-            s["line_no"] = lineno
-            s["label"] = ""
-            s["type"] = "ASM"
-            if (is_hex(s["opcode"]) and s["opcode"]!="ADD" and s["opcode"]!='DAA' and s["opcode"]!='DAD'):
-                s["type"] = "HEX"
-                s["data"] = []
-                for t in tokens:
-                    s["data"].append(int(t,16))
-            elif len(tokens) > 1:
-                s["op1"] = tokens[1].upper()
-                if len(tokens) > 2:
-                    if len(tokens) < 4 or tokens[2] != ",":
-                        print("Error: expected operand separated by comma\n\t"+line)
-                        return False
-                    s["op2"] = tokens[3].upper()
-            s["label"] = lastLabel
-            lastLabel = ""
-            self.asm.append(s)
-        return True
-    
+                    stmts.append(s)
+            else:
+                s = dict(fields)
+                s["line"] = line
+                s["line_no"] = lineno
+                s["file"] = file
+                s["label"] = lastLabel
+                lastLabel = ""
+                stmts.append(s)
+            carry.append(lastLabel)
+        return stmts, lineStmts, lineLabels, carry
+
+    def DuplicateLabel(self, name, line, later):
+        # A full assembly reports the second definition. When the existing one
+        # is on an unchanged line after the edit, that line is the second, so
+        # it goes into later's (line index -> first definition) and is raised
+        # by Reassemble once the lines before it have been lexed
+        if later is not None:
+            lines, newStart, oldStart, found = later
+            if name not in [ n for n, first in found.values() ] and name in self.lineLabels[oldStart:]:
+                i = newStart + self.lineLabels.index(name, oldStart) - oldStart
+                found[i] = (name, line)
+                return
+        raise Exception("Error: duplicate label name, previously defined at:\n\t"+self.labelLines[name])
+
+    def Reassemble(self, lines, first, oldEnd, newEnd, addr_base=0x8000):
+        # Replaces the previous source lines first:oldEnd by lines[first:newEnd].
+        # The lines after them are unchanged apart from their line numbers, so
+        # their statements keep their bytes and only move; the new statements
+        # and those using a label that moved are the only ones encoded again
+        self.index = None
+        for name in self.lineLabels[first:oldEnd]:
+            if name != "":
+                del self.labelLines[name]
+        pending = self.carry[first-1] if first else ""
+        kFirst = self.lineStmts[first] if first < len(self.lineStmts) else len(self.asm)
+        found = {}
+        stmts, lineStmts, lineLabels, carry = self.LexLines(lines[first:newEnd], pending, kFirst, (lines, newEnd, oldEnd, found))
+        # A label still pending after the new lines goes to the next statement,
+        # so unchanged lines are taken in until the same label is pending as before
+        while newEnd < len(lines) and (carry[-1] if carry else pending) != (self.carry[oldEnd-1] if oldEnd else ""):
+            if self.lineLabels[oldEnd] != "":
+                del self.labelLines[self.lineLabels[oldEnd]]
+            more = self.LexLines(lines[newEnd:newEnd+1], carry[-1] if carry else pending, kFirst + len(stmts),
+                                 (lines, newEnd+1, oldEnd+1, found))
+            stmts += more[0]
+            lineStmts += more[1]
+            lineLabels += more[2]
+            carry += more[3]
+            newEnd += 1
+            oldEnd += 1
+        if found:
+            i = min(found)
+            text, self.file, self.line_no, shared = lines[i]
+            self.line = comment_re.sub(r"\1", text)
+            raise Exception("Error: duplicate label name, previously defined at:\n\t"+found[i][1])
+
+        kOldEnd = self.lineStmts[oldEnd] if oldEnd < len(self.lineStmts) else len(self.asm)
+        kNew = kFirst + len(stmts)
+        dk = kNew - kOldEnd
+        for s in self.asm[kFirst:kOldEnd]:
+            for op in self.Operands(s):
+                users = self.refs.get(op)
+                if users:
+                    users.pop(id(s), None)
+        moved = {}
+        for name in set(self.lineLabels[first:oldEnd]) - set(lineLabels):
+            if name in self.labels:
+                moved[name] = self.labels.pop(name)
+        self.asm[kFirst:kOldEnd] = stmts
+        self.bytes_list[kFirst:kOldEnd] = [ self.Output(s) for s in stmts ]
+        suffix = self.lineStmts[oldEnd:]
+        self.lineStmts[first:] = lineStmts + ([ k + dk for k in suffix ] if dk else suffix)
+        self.lineLabels[first:oldEnd] = lineLabels
+        self.carry[first:oldEnd] = carry
+
+        # Line numbers after the change move with the source lines, which a
+        # MACRO definition takes up without producing any expanded lines
+        ends = self.lineStmts[newEnd+1:] + [ len(self.asm) ]
+        for i in range(newEnd, len(lines)):
+            lineno = lines[i][2]
+            for s in self.asm[self.lineStmts[i]:ends[i-newEnd]]:
+                if s["line_no"] == lineno:
+                    break
+                s["line_no"] = s["out"]["line_no"] = lineno
+
+        if self.layoutLabels or any(self.LayoutArg(s) for s in stmts):
+            # Label values feed the layout; lay everything out again so that
+            # forward references fail as they do in a full assembly
+            previous = self.labels
+            self.labels = {}
+            self.layoutLabels = set()
+            moved.update(self.Layout(0, addr_base, len(self.asm), 0, previous))
+            for name in previous.keys() - self.labels.keys():
+                moved.setdefault(name, previous[name])
+        else:
+            # A label pending into the change is set again by every statement it names
+            k = kFirst
+            while pending != "" and k > 0 and self.asm[k-1]["label"] == pending:
+                k -= 1
+            for name, old in self.Layout(k, addr_base, kNew, dk, self.labels).items():
+                moved.setdefault(name, old)
+
+        try:
+            for s in stmts:
+                self.EncodeOutput(s)
+            new = set(id(s) for s in stmts)
+            for name, old in moved.items():
+                if self.labels.get(name) == old:
+                    continue
+                for s in list(self.refs.get(name, {}).values()):
+                    if id(s) not in new:
+                        s["out"]["bytes"] = self.EncodeStatement(s)
+        except Exception:
+            # Raise from the first statement that fails, as a full assembly does
+            for s in self.asm:
+                self.EncodeStatement(s)
+            raise
+
     def AddByte(self, byte):
         if byte > 0xFF:
             raise Exception("Expected byte value: " + hex(byte))
         self.bytes.append(byte)
     
     def AddHexByte(self, num):
+        if not is_hex(num) and num in self.labels:
+            self.AddByte(self.labels[num])
+            return
         self.AddByte(int(num, 16))
 
     def AddHexWord(self, word):
@@ -264,6 +582,9 @@ class Assembler:
         elif not operand and not self.op1 is None:
             self.ErrorUnexpectedFirstOperand()
             return
+        if not operand:
+            self.AddByte(cnd_map[cnd]+offset)
+            return
         self.AddressInstruction(cnd_map[cnd]+offset)
 
     def AddressInstruction(self, opcode):
@@ -276,90 +597,362 @@ class Assembler:
             return
         self.AddHexWord(self.op1)
 
-    def CollectLabels(self, addr_base):
-        addr = addr_base
-        for s in self.asm:
-            if s["label"] != "":
-                if is_hex(s["label"]):
-                    addr = int(s["label"], 16)
+    def Operands(self, s):
+        if s["type"] == "DIR":
+            return s["args"]
+        if s["type"] == "ASM":
+            return (s["op1"], s["op2"])
+        return ()
+
+    def Value(self, token):
+        if is_hex(token):
+            return int(token, 16)
+        if token in self.labels:
+            return self.labels[token]
+        raise Exception("Invalid value or undefined label: " + token)
+
+    def StatementLen(self, s):
+        if s["type"] == "ASM":
+            return self.GetInsLen(s["opcode"])
+        if s["type"] == "DIR":
+            if s["opcode"] == 'DS':
+                return self.Value(s["args"][0])
+            return s.get("size", 0)
+        return len(s["data"])
+
+    def LayoutArg(self, s):
+        # The label an ORG, EQU or DS statement takes its value from, if any
+        if s["type"] == "DIR" and s["opcode"] in ('ORG', 'EQU', 'DS') and not is_hex(s["args"][0]):
+            return s["args"][0]
+        return None
+
+    def Layout(self, k, addr_base, kNew, dk, previous):
+        # Assigns addresses and labels from statement k on and returns the
+        # previous value of each label that changed. Statements from kNew on
+        # were laid out before at index - dk; the pass stops at the first of
+        # them that lands where it was, as nothing after it can move
+        asm = self.asm
+        labels = self.labels
+        old = self.addresses
+        addresses = old[:k]
+        if k > 0:
+            addr = addresses[k-1] + self.StatementLen(asm[k-1])
+        else:
+            addr = addr_base
+        moved = {}
+        j = k
+        while j < len(asm):
+            s = asm[j]
+            label = s["label"]
+            if j >= kNew and label == "" and addr == old[j-dk]:
+                addresses += old[j-dk:]
+                break
+            if s["type"] == "DIR":
+                self.line = s["line"]
+                self.line_no = s["line_no"]
+                self.file = s["file"]
+                arg = self.LayoutArg(s)
+                if arg is not None:
+                    self.layoutLabels.add(arg)
+                if s["opcode"] == 'ORG':
+                    addr = self.Value(s["args"][0])
+                elif s["opcode"] == 'EQU':
+                    value = self.Value(s["args"][0])
+                    if previous.get(s["name"]) != value:
+                        moved.setdefault(s["name"], previous.get(s["name"]))
+                    labels[s["name"]] = value
+            if label != "":
+                if is_hex(label):
+                    addr = int(label, 16)
                 else:
-                    self.labels[s["label"]] = addr
-            if s["type"] == "ASM":
-                addr += self.GetInsLen(s["opcode"])
-            else:
-                addr += len(s["data"])
-#        for k in self.labels:
-#            print(k, hex(self.labels[k]))
+                    if previous.get(label) != addr:
+                        moved.setdefault(label, previous.get(label))
+                    labels[label] = addr
+            addresses.append(addr)
+            s["out"]["address"] = addr
+            addr += self.StatementLen(s)
+            j += 1
+        self.addresses = addresses
+        return moved
 
     def Parse(self, addr_base=0x8000):
-        self.CollectLabels(addr_base)
-        addr = addr_base
+        self.index = None
+        self.labels = {}
+        self.refs = {}
+        self.layoutLabels = set()
+        self.addresses = []
+        self.bytes_list = [ self.Output(s) for s in self.asm ]
+        self.Layout(0, addr_base, len(self.asm), 0, {})
         for s in self.asm:
-            if s["label"] != "" and is_hex(s["label"]):
-                addr = int(s["label"], 16)
-            byte_list = {}
-            byte_list["address"] = addr
-            byte_list["bytes"] = []
-            byte_list["line_no"] = s["line_no"]
-            byte_list["asm"] = s["line"]
-            self.bytes = byte_list["bytes"]
-             
-            if s["type"] == "ASM":
-                oc = s["opcode"]
-                self.opcode = oc
-                self.op1 = s["op1"]
-                self.op2 = s["op2"]
-                self.line = s["line"]
-                self.line_no = s["line_no"]
-                if oc == "MVI":
-                    self.Mvi()
-                elif oc == "LXI":
-                    self.Lxi()
-                elif oc == "MOV":
-                    self.Mov()
-                elif oc == "INR":
-                    self.InrDcr()
-                elif oc == "DCR":
-                    self.InrDcr(-1)
-                elif oc == "INX":
-                    self.InxDcx()
-                elif oc == "DCX":
-                    self.InxDcx(0xA)
-                elif oc == "PUSH":
-                    self.Push()
-                elif oc == "POP":
-                    self.Pop()
-                elif oc == "RST":
-                    self.Rst()
-                elif oc == "DAD":
-                    self.Dad()
-                elif oc in addr_opcodes:
-                    self.AddressInstruction(addr_opcodes[oc])
-                elif oc in imm_opcodes:
-                    self.ImmediateInstruction()
-                elif oc in singlebytereg_opcodes:
-                    self.SingleByteRegParamInstruction()
-                elif oc in singlebyte_opcodes:
-                    self.SingleByteInstruction()
-                elif oc[1:] in cnd_map:
-                    if oc[:1] == 'J':
-                        self.Cnd()
-                    elif oc[:1] == 'C':
-                        self.Cnd(2)
-                    elif oc[:1] == 'R':
-                        self.Cnd(-2, False)
+            self.EncodeOutput(s)
+
+    def Output(self, s):
+        byte_list = {}
+        byte_list["line_no"] = s["line_no"]
+        byte_list["asm"] = s["line"]
+        s["out"] = byte_list
+        return byte_list
+
+    def EncodeOutput(self, s):
+        s["out"]["bytes"] = self.EncodeStatement(s)
+        for op in self.Operands(s):
+            if op in self.labels:
+                self.refs.setdefault(op, {})[id(s)] = s
+
+    def EncodeStatement(self, s):
+        if s["type"] == "DIR":
+            self.line = s["line"]
+            self.line_no = s["line_no"]
+            self.file = s["file"]
+            return self.EncodeDirective(s)
+        if s["type"] != "ASM":
+            self.bytes = []
+            for t in s["data"]:
+                while t > 0xFF:
+                    self.AddByte(t&0xFF)
+                    t = t >> 8
+                self.AddByte(t)
+            return self.bytes
+        self.line = s["line"]
+        self.line_no = s["line_no"]
+        self.file = s["file"]
+        labels = self.labels
+        cache = self.encodingCache
+        # Encoding only depends on the operands and the labels they name
+        key = (s["opcode"], s["op1"], s["op2"], labels.get(s["op1"]), labels.get(s["op2"]))
+        encoded = cache.get(key) if cache is not None else None
+        if encoded is None:
+            self.bytes = []
+            self.Encode(s)
+            encoded = tuple(self.bytes)
+            if cache is not None:
+                cache[key] = encoded
+        return list(encoded)
+
+    def EncodeDirective(self, s):
+        data = bytearray()
+        if s["opcode"] == 'DB':
+            for a in s["args"]:
+                if a[0] in "\"'":
+                    data += a[1:-1].encode('latin-1')
                 else:
-                    raise Exception("Invalid assembly instruction")
-            else:
-                for t in s["data"]:
-                    while t > 0xFF:
-                        self.AddByte(t&0xFF)
-                        t = t >> 8
-                    self.AddByte(t)
-            
-            if s["type"] == "ASM":
-                addr += self.GetInsLen(s["opcode"])
-            else:
-                addr += len(s["data"])
-            self.bytes_list.append(byte_list)
+                    value = self.Value(a)
+                    if value > 0xFF:
+                        raise Exception("Expected byte value: " + hex(value))
+                    data.append(value)
+        elif s["opcode"] == 'DW':
+            for a in s["args"]:
+                value = self.Value(a)
+                if value > 0xFFFF:
+                    raise Exception("Expected word value: " + hex(value))
+                data += bytes([ value & 0xFF, value >> 8 ])
+        elif s["opcode"] == 'DS' and len(s["args"]) == 2:
+            value = self.Value(s["args"][1])
+            if value > 0xFF:
+                raise Exception("Expected byte value: " + hex(value))
+            data = bytearray([ value ]) * self.Value(s["args"][0])
+        return list(data)
+
+    def Encode(self, s):
+        oc = s["opcode"]
+        self.opcode = oc
+        self.op1 = s["op1"]
+        self.op2 = s["op2"]
+        if oc == "MVI":
+            self.Mvi()
+        elif oc == "LXI":
+            self.Lxi()
+        elif oc == "MOV":
+            self.Mov()
+        elif oc == "INR":
+            self.InrDcr()
+        elif oc == "DCR":
+            self.InrDcr(-1)
+        elif oc == "INX":
+            self.InxDcx()
+        elif oc == "DCX":
+            self.InxDcx(0xA)
+        elif oc == "PUSH":
+            self.Push()
+        elif oc == "POP":
+            self.Pop()
+        elif oc == "RST":
+            self.Rst()
+        elif oc == "DAD":
+            self.Dad()
+        elif oc in addr_opcodes:
+            self.AddressInstruction(addr_opcodes[oc])
+        elif oc in imm_opcodes:
+            self.ImmediateInstruction()
+        elif oc in singlebytereg_opcodes:
+            self.SingleByteRegParamInstruction()
+        elif oc in singlebyte_opcodes:
+            self.SingleByteInstruction()
+        elif oc[1:] in cnd_map:
+            if oc[:1] == 'J':
+                self.Cnd()
+            elif oc[:1] == 'C':
+                self.Cnd(2)
+            elif oc[:1] == 'R':
+                self.Cnd(-2, False)
+        else:
+            raise Exception("Invalid assembly instruction")
+
+    def GetSegments(self):
+        image = bytearray(0x10000)
+        used = bytearray(0x10000)
+        for byte_list in self.bytes_list:
+            addr = byte_list["address"]
+            size = len(byte_list["bytes"])
+            if addr + size > 0x10000:
+                raise Exception("Code exceeds address space at: " + hex(addr))
+            image[addr:addr+size] = bytes(byte_list["bytes"])
+            used[addr:addr+size] = b'\x01' * size
+        segments = []
+        start = used.find(1)
+        while start != -1:
+            end = used.find(0, start)
+            if end == -1:
+                end = 0x10000
+            segments.append((start, bytes(image[start:end])))
+            start = used.find(1, end)
+        return segments
+
+    def Index(self):
+        # Built on first use after each Parse
+        if self.index is None:
+            self.index = SourceIndex(self)
+        return self.index
+
+    def WriteHex(self, fp):
+        WriteHex(fp, self.GetSegments())
+
+    def WriteBinary(self, fp):
+        return WriteBinary(fp, self.GetSegments())
+
+
+class SourceIndex:
+    """Maps addresses to source lines and labels, and lines back to addresses"""
+
+    def __init__(self, asm):
+        entries = sorted((b["address"], len(b["bytes"]), j) for j, b in enumerate(asm.bytes_list) if b["bytes"])
+        self.starts = array('L', (addr for addr, size, j in entries))
+        self.ends = array('L', (addr + size for addr, size, j in entries))
+        self.statements = array('L', (j for addr, size, j in entries))
+        self.source = asm.asm
+        self.labels = asm.labels
+
+        # Only labels on statements name code or data; EQU constants are skipped
+        named = sorted((asm.labels[s["label"]], s["label"]) for s in asm.asm
+                       if s["label"] != "" and s["label"] in asm.labels)
+        self.labelStarts = array('L', (addr for addr, name in named))
+        self.labelNames = [ name for addr, name in named ]
+
+        self.lineAddresses = {}
+        for addr, size, j in reversed(entries):
+            s = asm.asm[j]
+            self.lineAddresses[(s["file"], s["line_no"])] = addr
+
+    def Lookup(self, addr):
+        # Returns the statement covering addr, or None outside the program
+        i = bisect_right(self.starts, addr) - 1
+        if i < 0 or addr >= self.ends[i]:
+            return None
+        s = self.source[self.statements[i]]
+        label, offset = self.Label(addr)
+        return { "address":self.starts[i], "line_no":s["line_no"], "file":s["file"], "asm":s["line"],
+                 "label":label, "offset":offset }
+
+    def Label(self, addr):
+        i = bisect_right(self.labelStarts, addr) - 1
+        if i < 0:
+            return None, addr
+        return self.labelNames[i], addr - self.labelStarts[i]
+
+    def LabelAddress(self, name):
+        return self.labels.get(name.upper())
+
+    def LineAddress(self, line_no, file=None):
+        return self.lineAddresses.get((file, line_no))
+
+    def Describe(self, addr):
+        entry = self.Lookup(addr)
+        if entry is None:
+            return hex(addr)
+        where = entry["label"] + ("+" + str(entry["offset"]) if entry["offset"] else "") if entry["label"] else hex(addr)
+        source = (entry["file"] + ":" if entry["file"] else "line ") + str(entry["line_no"])
+        return where + " (" + source + ": " + entry["asm"].strip() + ")"
+
+
+class AssemblerSession:
+    """Reassembles an edited source, redoing only the lines that changed"""
+
+    def __init__(self, includePath=()):
+        self.includePath = list(includePath)
+        self.lineCache = {}
+        self.encodingCache = {}
+        self.lines = []
+        self.source = None
+        self.addr = None
+        self.asm = None
+        self.current = None
+
+    def Assemble(self, source, addr=0x8000):
+        if self.asm is not None and source == self.source and addr == self.addr and not self.IncludesChanged():
+            return self.asm
+        asm = self.asm
+        self.asm = None
+        if asm is None or addr != self.addr:
+            asm = Assembler(self.lineCache, self.encodingCache)
+            self.lines = []
+        asm.includePath = list(self.includePath)
+        self.current = asm
+        lines = asm.Expand(source)
+        limit = 4 * len(lines) + 4096
+        if len(self.lineCache) > limit:
+            self.lineCache.clear()
+        if len(self.encodingCache) > limit:
+            self.encodingCache.clear()
+
+        first = 0
+        last = min(len(lines), len(self.lines))
+        while first < last and lines[first] == self.lines[first]:
+            first += 1
+        # Lines after the change are unchanged if their text is; their line
+        # numbers shift with the lines inserted or removed
+        tail = 0
+        last -= first
+        while tail < last:
+            text, file, line_no, shared = lines[-1-tail]
+            old = self.lines[-1-tail]
+            if text != old[0] or file != old[1] or shared != old[3]:
+                break
+            tail += 1
+        asm.Reassemble(lines, first, len(self.lines) - tail, len(lines) - tail, addr)
+        self.asm = asm
+        self.lines = lines
+        self.source = source
+        self.addr = addr
+        return asm
+
+    def IncludesChanged(self):
+        for path, stamp in self.asm.includes.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                return True
+            if (st.st_mtime_ns, st.st_size) != stamp:
+                return True
+        return False
+
+    @property
+    def line(self):
+        return getattr(self.current, "line", "")
+
+    @property
+    def file(self):
+        return getattr(self.current, "file", None)
 
+    @property
+    def line_no(self):
+        return getattr(self.current, "line_no", 0)
@@ -0,0 +1,155 @@
+from Machine import Machine
+from Assembler import Assembler
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+import io
+
+EXIT_OK = 0
+EXIT_ASSEMBLY = 1
+EXIT_RUNTIME = 2
+EXIT_STEP_LIMIT = 3
+EXIT_TIMEOUT = 4
+EXIT_BREAKPOINT = 5
+
+status_codes = { "halted":EXIT_OK, "step-limit":EXIT_STEP_LIMIT, "timeout":EXIT_TIMEOUT,
+                 "breakpoint":EXIT_BREAKPOINT, "watchpoint":EXIT_BREAKPOINT }
+
+def ParseAddress(text, labels):
+    if isinstance(text, int):
+        return text
+    if text.upper() in labels:
+        return labels[text.upper()]
+    return int(text, 16)
+
+def DumpRange(machine, spec, labels):
+    start, _, length = spec.partition(':')
+    try:
+        addr = ParseAddress(start, labels)
+        length = int(length) if length else 1
+        return { "address":addr, "data":machine.bus.ReadBlock(addr, length).hex() }
+    except Exception as ex:
+        return { "error":str(ex) }
+
+def AddWatchpoint(machine, spec, labels, stop):
+    # ADDR[:LEN[:ACCESS]] with ACCESS r, w or rw (default)
+    start, _, rest = spec.partition(':')
+    length, _, access = rest.partition(':')
+    addr = ParseAddress(start, labels)
+    length = int(length) if length else 1
+    machine.bus.AddWatchpoint(addr, addr + length - 1, access.lower() or 'rw', stop)
+
+def ApplyInputs(machine, inputs):
+    for addr, data in inputs.get("memory", {}).items():
+        machine.bus.WriteBlock(addr, data)
+    for addr, ports in inputs.get("ppi", {}).items():
+        ppi = machine.AddPPI(addr)
+        for port, value in ports.items():
+            setattr(ppi, port, value)
+
+def EmitImage(source, path, addr=0x8000, format="hex", includePath=()):
+    asm = Assembler(includePath=includePath)
+    asm.Lex(source)
+    asm.Parse(addr)
+    if format == "hex":
+        with open(path, 'w') as fp:
+            asm.WriteHex(fp)
+    else:
+        with open(path, 'wb') as fp:
+            asm.WriteBinary(fp)
+    return asm
+
+def RunProgram(machine, source, addr=0x8000, inputs=None, start=None, maxSteps=None, timeout=None,
+               dumps=(), regs=False, labels=False, blockMode=True, clockRate=None, includePath=(),
+               breakpoints=(), watches=(), watchLogs=(), trace=None):
+    result = {}
+    machine.Reset(True)
+    labelMap = {}
+    try:
+        if isinstance(source, (bytes, bytearray)):
+            machine.LoadImage(source, addr)
+        else:
+            with redirect_stdout(io.StringIO()) as out:
+                try:
+                    asm = machine.Assemble(source, addr, includePath)
+                finally:
+                    if out.getvalue():
+                        result["messages"] = out.getvalue()
+            machine.Load(asm)
+            labelMap = asm.labels
+    except Exception as ex:
+        result["status"] = "assembly-error"
+        result["error"] = str(ex)
+        if machine.asm is not None and hasattr(machine.asm, 'line_no'):
+            result["line_no"] = machine.asm.line_no
+            result["line"] = machine.asm.line
+            if machine.asm.file:
+                result["source"] = machine.asm.file
+        return result, EXIT_ASSEMBLY
+
+    machine.cu.blockMode = blockMode
+    machine.cu.SetClockRate(clockRate)
+    try:
+        ApplyInputs(machine, inputs or {})
+        machine.cu.SetBreakpoints(ParseAddress(spec, labelMap) for spec in breakpoints)
+        machine.bus.ClearWatchpoints()
+        for spec in watches:
+            AddWatchpoint(machine, spec, labelMap, True)
+        for spec in watchLogs:
+            AddWatchpoint(machine, spec, labelMap, False)
+        pc = addr if start is None else ParseAddress(start, labelMap)
+        if trace:
+            with open(trace, 'wb') as fp:
+                machine.cu.StartTrace(stream=fp)
+                try:
+                    status = machine.Run(pc, maxSteps, timeout)
+                finally:
+                    result["traced"] = machine.cu.StopTrace().count
+        else:
+            status = machine.Run(pc, maxSteps, timeout)
+        code = status_codes[status]
+    except Exception as ex:
+        status = "runtime-error"
+        result["error"] = str(ex)
+        if machine.asm is not None:
+            result["at"] = machine.asm.Index().Describe(machine.cu.instrPC)
+        code = EXIT_RUNTIME
+
+    result["status"] = status
+    result["steps"] = machine.cu.steps
+    result["cycles"] = machine.cu.cycles
+    result["pc"] = machine.cu.GetPC()
+    if machine.cu.watchAt is not None:
+        addr, access, value = machine.cu.watchAt
+        result["watchpoint"] = { "address":addr, "access":access, "value":value }
+    if watchLogs:
+        result["watch"] = [ { "pc":pc, "address":addr, "access":access, "value":value }
+                            for pc, addr, access, value in machine.cu.watchLog ]
+    if regs:
+        result["registers"] = dict(machine.alu.registers.items())
+    if labels:
+        result["labels"] = labelMap
+    if dumps:
+        result["memory"] = { spec:DumpRange(machine, spec, labelMap) for spec in dumps }
+    return result, code
+
+
+worker_machine = None
+
+def WorkerInit():
+    global worker_machine
+    worker_machine = Machine()
+
+def WorkerRun(job, options):
+    if worker_machine is None:
+        WorkerInit()
+    return RunProgram(worker_machine, *job, **options)
+
+def RunBatch(jobs, workers=None, jobOptions=None, **options):
+    # jobOptions optionally holds one dict of extra options per job
+    with ProcessPoolExecutor(max_workers=workers, initializer=WorkerInit) as pool:
+        futures = { pool.submit(WorkerRun, tuple(job), dict(options, **(jobOptions[i] if jobOptions else {}))):i
+                    for i, job in enumerate(jobs) }
+        for future in as_completed(futures):
+            result, code = future.result()
+            yield futures[future], result, code
@@ -1,38 +1,219 @@
 
+class SharedRange:
+    def __init__(self, entries):
+        self.entries = entries
+
+    def Read(self, addr):
+        for k, start, end in self.entries:
+            if addr >= start and addr <= end:
+                return k.Read(addr)
+        raise Exception("Invalid address to read: " + hex(addr))
+
+    def Write(self, addr, value):
+        for k, start, end in self.entries:
+            if addr >= start and addr <= end:
+                k.Write(addr, value)
+
+
+class WatchedPage:
+    """Wraps a page that has watchpoints; only accesses to these pages pay for the checks"""
+
+    def __init__(self, bus, page, watchpoints):
+        self.bus = bus
+        self.page = page
+        self.watchpoints = watchpoints
+
+    def Read(self, addr):
+        value = self.page.Read(addr)
+        for start, end, access, stop in self.watchpoints:
+            if addr >= start and addr <= end and 'r' in access:
+                self.bus.watchHandler(addr, 'r', value, stop)
+        return value
+
+    def Write(self, addr, value):
+        self.page.Write(addr, value)
+        if self.bus.writeTrace is not None:
+            self.bus.writeTrace(addr, value)
+        for start, end, access, stop in self.watchpoints:
+            if addr >= start and addr <= end and 'w' in access:
+                self.bus.watchHandler(addr, 'w', value, stop)
+
+    # Block transfers come from loaders and debug views, not the program
+    def ReadBlock(self, addr, length):
+        if hasattr(self.page, 'ReadBlock'):
+            return self.page.ReadBlock(addr, length)
+        return bytes(self.page.Read(a) for a in range(addr, addr+length))
+
+    def WriteBlock(self, addr, data):
+        if hasattr(self.page, 'WriteBlock'):
+            return self.page.WriteBlock(addr, data)
+        for i, byte in enumerate(data):
+            self.page.Write(addr+i, byte)
+
+
 class Bus:
     def __init__(self):
         self.mem_peripherals = {}
         self.io_peripherals = {}
+        self.memPages = [ SharedRange([]) ] * 256
+        self.mappedPages = self.memPages
+        # Read and Write of each page in memPages, updated in place so that
+        # translated code can keep them and skip ReadMemory and WriteMemory
+        self.pageReads = [ page.Read for page in self.memPages ]
+        self.pageWrites = [ page.Write for page in self.memPages ]
+        self.watchpoints = []
+        self.watchHandler = None
+        self.writeTrace = None
+        self.ioPorts = [ SharedRange([]) ] * 256
+        self.codeMap = bytearray(0x10000)
+        self.codeWriteHandler = None
+
+    def BuildMap(self, peripherals, size, shift):
+        slots = [ [] for i in range(size) ]
+        for k,v in peripherals.items():
+            first = max(v[0], 0) >> shift
+            last = min(v[1] >> shift, size - 1)
+            for i in range(first, last+1):
+                slots[i].append((k, v[0], v[1]))
+        table = []
+        for i, entries in enumerate(slots):
+            low = i << shift
+            high = ((i + 1) << shift) - 1
+            if len(entries) == 1 and entries[0][1] <= low and entries[0][2] >= high:
+                table.append(entries[0][0])
+            else:
+                table.append(SharedRange(entries))
+        return table
 
     def AddMemoryPeripheral(self, peripheral, startAddr, endAddr):
         self.mem_peripherals[peripheral] = (startAddr, endAddr)
+        self.mappedPages = self.BuildMap(self.mem_peripherals, 256, 8)
+        self.BuildWatchMap()
+
+    def BuildWatchMap(self):
+        pages = list(self.mappedPages)
+        for i in range(256):
+            low = i << 8
+            high = low + 0xFF
+            watched = [ w for w in self.watchpoints if w[0] <= high and w[1] >= low ]
+            if watched or self.writeTrace is not None:
+                pages[i] = WatchedPage(self, pages[i], watched)
+        self.memPages = pages
+        self.pageReads[:] = [ page.Read for page in pages ]
+        self.pageWrites[:] = [ page.Write for page in pages ]
+
+    def AddWatchpoint(self, startAddr, endAddr, access='rw', stop=True):
+        # access is any of 'r' and 'w'; the handler decides what stop means
+        self.watchpoints.append((startAddr, endAddr, access, stop))
+        self.BuildWatchMap()
+
+    def RemoveWatchpoint(self, startAddr, endAddr):
+        self.watchpoints = [ w for w in self.watchpoints if (w[0], w[1]) != (startAddr, endAddr) ]
+        self.BuildWatchMap()
+
+    def ClearWatchpoints(self):
+        self.watchpoints = []
+        self.BuildWatchMap()
+
+    def SetWatchHandler(self, handler):
+        self.watchHandler = handler
+
+    def SetWriteTrace(self, handler):
+        # While set, every page goes through the watched path and reports writes
+        self.writeTrace = handler
+        self.BuildWatchMap()
+
+    def PeekMemory(self, addr):
+        # Reads without triggering watchpoints, for instruction fetch and debug views
+        try:
+            page = self.mappedPages[addr >> 8]
+        except IndexError:
+            raise Exception("Invalid address to read: " + hex(addr))
+        return page.Read(addr)
 
     def ReadMemory(self, addr):
-        for k,v in self.mem_peripherals.items():
-            if addr >= v[0] and addr <= v[1]:
-                return k.Read(addr)
-        raise Exception("Invalid address to read: " + hex(addr))
+        try:
+            page = self.memPages[addr >> 8]
+        except IndexError:
+            raise Exception("Invalid address to read: " + hex(addr))
+        return page.Read(addr)
 
     def WriteMemory(self, addr, value):
-        for k,v in self.mem_peripherals.items():
-            if addr >= v[0] and addr <= v[1]:
-                k.Write(addr, value)
+        try:
+            page = self.memPages[addr >> 8]
+        except IndexError:
+            return
+        page.Write(addr, value)
+        if self.codeMap[addr & 0xFFFF]:
+            self.codeWriteHandler(addr)
+
+    def Runs(self, addr, length):
+        end = addr + length
+        if addr < 0 or length < 0 or end > 0x10000:
+            raise Exception("Invalid address range: " + hex(addr) + " - " + hex(end-1))
+        while addr < end:
+            page = self.memPages[addr >> 8]
+            stop = ((addr >> 8) + 1) << 8
+            while stop < end and self.memPages[stop >> 8] is page:
+                stop += 0x100
+            stop = min(stop, end)
+            yield page, addr, stop - addr
+            addr = stop
+
+    def IsMapped(self, addr, length):
+        for page, start, size in self.Runs(addr, length):
+            if not isinstance(page, SharedRange):
+                continue
+            for a in range(start, start+size):
+                if not any(a >= v[1] and a <= v[2] for v in page.entries):
+                    return False
+        return True
+
+    def ReadBlock(self, addr, length):
+        data = bytearray()
+        for page, start, size in self.Runs(addr, length):
+            if hasattr(page, 'ReadBlock'):
+                data += page.ReadBlock(start, size)
+            else:
+                data += bytes(page.Read(a) for a in range(start, start+size))
+        return bytes(data)
+
+    def WriteBlock(self, addr, data):
+        data = memoryview(bytes(data))
+        for page, start, size in self.Runs(addr, len(data)):
+            chunk = data[start-addr:start-addr+size]
+            if hasattr(page, 'WriteBlock'):
+                page.WriteBlock(start, chunk)
+            else:
+                for i, byte in enumerate(chunk):
+                    page.Write(start+i, byte)
+        end = addr + len(data)
+        pos = self.codeMap.find(1, addr, end)
+        while pos != -1:
+            self.codeWriteHandler(pos)
+            pos = self.codeMap.find(1, pos+1, end)
+
+    def SetCodeWriteHandler(self, handler):
+        self.codeWriteHandler = handler
+
+    def MarkCode(self, startAddr, endAddr):
+        self.codeMap[startAddr:endAddr+1] = b'\x01' * (endAddr - startAddr + 1)
+
+    def ClearCode(self):
+        self.codeMap[:] = bytes(0x10000)
 
     def AddIOPeripheral(self, peripheral, startAddr, endAddr):
         self.io_peripherals[peripheral] = (startAddr, endAddr)
+        self.ioPorts = self.BuildMap(self.io_peripherals, 256, 0)
 
     def RemoveIOPeripheral(self, peripheral):
         if peripheral in self.io_peripherals:
             del self.io_peripherals[peripheral]
+            self.ioPorts = self.BuildMap(self.io_peripherals, 256, 0)
 
     def ReadIO(self, addr):
-        for k,v in self.io_peripherals.items():
-            if addr >= v[0] and addr <= v[1]:
-                return k.Read(addr)
-        raise Exception("Invalid address to write: " + hex(addr))
+        return self.ioPorts[addr].Read(addr)
 
     def WriteIO(self, addr, value):
-        for k,v in self.io_peripherals.items():
-            if addr >= v[0] and addr <= v[1]:
-                k.Write(addr, value)
+        self.ioPorts[addr].Write(addr, value)
 
@@ -1,5 +1,11 @@
 
-from ALU import ALU
+from ALU import ALU, add_table, sub_table, szp_table
+from Trace import Tracer, trace_capacity
+from Rewind import History, snapshot_interval
+from functools import partial
+from threading import Timer, Thread, Event, Lock
+from collections import deque
+import time
 
 regOffset = [ 'B', 'C', 'D', 'E', 'H', 'L', 'M', 'A' ]
 regPair = { 'H':'L', 'B':'C', 'D':'E', 'A':'F' }
@@ -10,37 +16,111 @@ push_map = { 0xC5:'B', 0xD5:'D', 0xE5:'H', 0xF5:'A' }
 pop_map = { 0xC1:'B', 0xD1:'D', 0xE1:'H', 0xF1:'A' }
 mov_map = { 0x78:'A', 0x40:'B', 0x48:'C', 0x50:'D', 0x58:'E', 0x60:'H', 0x68:'L', 0x70:'M' }
 rst_map = [ 0xC7, 0xCF, 0xD7, 0xDF, 0xE7, 0xEF, 0xF7, 0xFF ]
-cnd_map = { 0xC2:'NZ', 0xCA:'Z', 0xD2:'NC', 0xDA:'C', 0xE2:'PO', 0xF2:'P', 0xFA:'M' }
-
-aux_word = 0
-def CheckOffset(byte, base):
-    global aux_word
-    diff = byte - base
-    if diff >= 0 and diff < 8:
-        aux_word = base
-        return True
-    return False
+cnd_map = { 0xC2:'NZ', 0xCA:'Z', 0xD2:'NC', 0xDA:'C', 0xE2:'PO', 0xEA:'PE', 0xF2:'P', 0xFA:'M' }
+dad_map = { 0x09:'B', 0x19:'D', 0x29:'H', 0x39:'SP' }
+
+branch_ops = set([ 0xC3, 0xCD, 0xC9, 0xE9, 0x76, 0xFB, 0x30 ] + rst_map + list(cnd_map) +
+                 [ op+2 for op in cnd_map ] + [ op-2 for op in cnd_map ])
+# Conditional jumps, calls and returns leave a block only when taken
+cond_ops = set(list(cnd_map) + [ op+2 for op in cnd_map ] + [ op-2 for op in cnd_map ])
+store_ops = set([ 0x36, 0x34, 0x35, 0x32, 0x22, 0x02, 0x12, 0xE3 ] + list(range(0x70, 0x78)) + list(push_map))
+max_block_len = 64
+
+# Python source for register operands and branch conditions in translated
+# blocks. R is the register file; rd and wr are the Bus's ReadMemory and
+# WriteMemory, and rp and wp its per-page Read and Write for addresses that
+# can't leave the 64K space
+reg_source = [ "R.B", "R.C", "R.D", "R.E", "R.H", "R.L", "rp[R.H]((R.H << 8) | R.L)", "R.A" ]
+cnd_source = { 'NZ':"not R.F & 0x40", 'Z':"R.F & 0x40", 'NC':"not R.F & 0x01", 'C':"R.F & 0x01",
+               'PO':"not R.F & 0x04", 'PE':"R.F & 0x04", 'P':"not R.F & 0x80", 'M':"R.F & 0x80" }
+# ADD, ADC, SUB, SBB, ANA, XRA, ORA, CMP and their immediate forms, on operand {0}
+alu_source = [ [ "v = add[(R.A << 8) | {0}]", "R.A = v & 0xFF", "R.F = v >> 8" ],
+               [ "v = add[((R.F & 0x01) << 16) | (R.A << 8) | {0}]", "R.A = v & 0xFF", "R.F = v >> 8" ],
+               [ "v = sub[(R.A << 8) | {0}]", "R.A = v & 0xFF", "R.F = v >> 8" ],
+               [ "v = sub[((R.F & 0x01) << 16) | (R.A << 8) | {0}]", "R.A = v & 0xFF", "R.F = v >> 8" ],
+               [ "R.A &= {0}", "R.F = szp[R.A] | 0x10" ],
+               [ "R.A ^= {0}", "R.F = szp[R.A]" ],
+               [ "R.A |= {0}", "R.F = szp[R.A]" ],
+               [ "R.F = sub[(R.A << 8) | {0}] >> 8" ] ]
+memory_source = ( "rd(", "wr(", "rp[", "wp[" )
 
-def CheckMov(byte):
-    for i in mov_map:
-        if CheckOffset(byte, i):
-            return True
-    return False
+def WriteSource(page, addr, value):
+    # A store through wp, dropping translated code it overwrites as
+    # Bus.WriteMemory does
+    return [ "wp[%s](%s, %s)" % (page, addr, value), "if code[%s]:" % addr, "    inval(%s)" % addr ]
+pace_interval = 0.01
+max_pace_lag = 0.1
+no_sync = 1 << 62
+max_watch_log = 1000
 
+# Pending interrupt bits; RST 5.5/6.5/7.5 share their bit positions with the SIM/RIM masks
+int_rst55 = 0x01
+int_rst65 = 0x02
+int_rst75 = 0x04
+int_intr = 0x08
+int_trap = 0x10
 
 class CU:
     def __init__(self, alu, bus):
         self.alu = alu
+        self.regs = alu.registers
         self.bus = bus
+        self.BuildTable()
 
-    def Reset(self):
+        self.blockMode = True
         self.running = False
+        self.halted = False
+        self.steps = 0
+        self.cycles = 0
+        self.clockRate = None
+        self.syncCycles = 0
+        self.syncTime = 0.0
+        self.nextSync = no_sync
+        self.error = None
+        self.completed = Event()
+        self.completed.set()
+        self.completionHandler = None
+        self.pending = 0
+        self.pendingLock = Lock()
+        self.interrupters = {}
+        self.intrVector = 0
+        self.snapshot = None
+        self.snapshotWindow = (None, 0)
+        self.snapshotRequested = False
+        self.breakpoints = set()
+        self.breakAt = None
+        self.watchAt = None
+        self.watchLog = deque(maxlen=max_watch_log)
+        self.tracer = None
+        self.history = None
+        self.stepBase = 0
+        self.blocks = {}
+        self.blockEnds = {}
+        self.blockPages = {}
+        self.stale = False
+        self.bus.SetCodeWriteHandler(self.InvalidateCode)
+        self.bus.SetWatchHandler(self.OnWatch)
+
+    def Reset(self, keepHistory=False):
+        # keepHistory leaves the recorded snapshots and the position in place,
+        # so a finished run can still be stepped back
+        self.running = False
+        self.halted = False
+        self.stepBase = self.Position() if keepHistory and self.history is not None else 0
+        self.steps = 0
+        self.cycles = 0
         self.opcode = 0x0
+        self.instrPC = 0
         self.intMasks = 0x07
         self.intEnable = False
 
-        self.interrupter = None
-        self.interrupt = -1
+        with self.pendingLock:
+            self.pending = 0
+            self.interrupters = {}
+        self.FlushBlocks()
+        self.watchLog.clear()
+        if self.history is not None and not keepHistory:
+            self.history.Clear()
 
         self.bus.WriteMemory(0x0028, 0x76)
         self.bus.WriteMemory(0x002C, 0xC3)
@@ -51,183 +131,464 @@ class CU:
         self.bus.WriteMemory(0x0036, 0x8F)
     
     def GetPC(self):
-        return self.alu.registers['PC']
+        return self.regs.PC
 
     def SetPC(self, addr):
-        self.alu.registers['PC'] = addr
+        self.regs.PC = addr
+
+    def Raise(self, bit, interrupter=None):
+        with self.pendingLock:
+            self.pending |= bit
+            if interrupter is not None:
+                self.interrupters[bit] = interrupter
 
     def TRAP(self):
-        self.Rst(0x0024)
+        self.Raise(int_trap)
 
     def RST(self, n, interrupter):
-        i = int(n-5.5)
-        if self.intMasks & (0x1 << i) == (0x1 << i):
+        bit = 0x1 << int(n-5.5)
+        if self.intMasks & bit == bit:
             return
-        self.interrupter = interrupter
-        self.interrupt = i
+        self.Raise(bit, interrupter)
+
+    def INTR(self, addr, interrupter=None):
+        self.intrVector = addr
+        self.Raise(int_intr, interrupter)
         
-    def Run(self):
+    def Run(self, maxSteps=None, timeout=None):
+        self.running = True
+        self.halted = False
+        self.stepBase += self.steps
+        self.steps = 0
+        self.error = None
+        self.breakAt = None
+        self.watchAt = None
+        self.completed.clear()
+        timer = None
+        if timeout is not None:
+            timer = Timer(timeout, self.Stop)
+            timer.daemon = True
+            timer.start()
+        if self.history is not None:
+            self.history.Take()
+        self.StartPacing()
+        try:
+            if self.tracer is not None:
+                self.RunTraced(maxSteps)
+            elif self.breakpoints:
+                self.RunToBreakpoint(maxSteps)
+            elif self.blockMode:
+                self.RunBlocks(maxSteps)
+            else:
+                self.RunSteps(maxSteps)
+        except Exception as ex:
+            self.error = ex
+            raise
+        finally:
+            self.running = False
+            if timer:
+                timer.cancel()
+            if self.tracer is not None:
+                self.tracer.Flush()
+            self.completed.set()
+            if self.completionHandler:
+                self.completionHandler(self.error)
+
+    def Start(self, maxSteps=None, timeout=None):
+        # Errors are kept in self.error and passed to the completion handler
+        def target():
+            try:
+                self.Run(maxSteps, timeout)
+            except Exception:
+                pass
         self.running = True
-        while self.running:
-            self.SingleStep()
+        self.completed.clear()
+        thread = Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def Wait(self, timeout=None):
+        return self.completed.wait(timeout)
+
+    def SetCompletionHandler(self, handler):
+        self.completionHandler = handler
+
+    def Stop(self):
+        self.running = False
+
+    def RequestSnapshot(self, addr=None, length=0):
+        # Taken by the CU thread at the next instruction or block boundary;
+        # addr None means the window starts at PC
+        self.snapshotWindow = (addr, length)
+        self.snapshotRequested = True
+        self.nextSync = 0
+
+    def TakeSnapshot(self):
+        self.snapshotRequested = False
+        regs = self.regs
+        addr, length = self.snapshotWindow
+        if addr is None:
+            addr = regs.PC
+        length = min(length, 0x10000 - addr)
+        try:
+            memory = self.bus.ReadBlock(addr, length)
+        except Exception:
+            memory = None
+        self.snapshot = ((regs.A, regs.B, regs.C, regs.D, regs.E, regs.H, regs.L, regs.F, regs.SP, regs.PC),
+                         addr, memory, self.steps, self.cycles)
+
+    def Sync(self):
+        if self.snapshotRequested:
+            self.TakeSnapshot()
+        self.Pace()
+        if self.history is not None:
+            if self.cycles >= self.history.nextCycles:
+                self.history.Take()
+            self.nextSync = min(self.nextSync, self.history.nextCycles)
+
+    def SetClockRate(self, hz=None):
+        # The CU thread may pace with the new rate as soon as it is set,
+        # so the sync reference has to be in place first
+        self.syncCycles = self.cycles
+        self.syncTime = time.perf_counter()
+        self.clockRate = hz
+        if self.running:
+            self.StartPacing()
+
+    def StartPacing(self):
+        if not self.clockRate:
+            self.nextSync = 0 if self.snapshotRequested else no_sync
+        else:
+            self.syncCycles = self.cycles
+            self.syncTime = time.perf_counter()
+            self.nextSync = 0 if self.snapshotRequested else self.cycles + int(self.clockRate * pace_interval)
+        if self.history is not None:
+            self.nextSync = min(self.nextSync, self.history.nextCycles)
+
+    def Pace(self):
+        clockRate = self.clockRate
+        if not clockRate:
+            self.nextSync = no_sync
+        else:
+            target = self.syncTime + (self.cycles - self.syncCycles) / clockRate
+            delay = target - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -max_pace_lag:
+                self.syncCycles = self.cycles
+                self.syncTime = time.perf_counter()
+            self.nextSync = self.cycles + int(clockRate * pace_interval)
+        # RequestSnapshot sets the flag before nextSync, so a request made
+        # while nextSync was being replaced is still seen here
+        if self.snapshotRequested:
+            self.nextSync = 0
+
+    def RunSteps(self, maxSteps=None):
+        while self.running and (maxSteps is None or self.steps < maxSteps):
+            self.FetchAndDecode()
+            if self.pending:
+                self.ProcessInterrupts()
+            self.steps += 1
+            if self.cycles >= self.nextSync:
+                self.Sync()
+
+    def RunToBreakpoint(self, maxSteps=None):
+        # The instruction at the starting PC always runs, so a stopped
+        # program can continue from its breakpoint
+        breakpoints = self.breakpoints
+        regs = self.regs
+        while self.running and (maxSteps is None or self.steps < maxSteps):
+            self.FetchAndDecode()
+            if self.pending:
+                self.ProcessInterrupts()
+            self.steps += 1
+            if self.cycles >= self.nextSync:
+                self.Sync()
+            if regs.PC in breakpoints:
+                self.breakAt = regs.PC
+                self.running = False
+
+    def RunTraced(self, maxSteps=None):
+        # Same as RunToBreakpoint, recording every instruction
+        breakpoints = self.breakpoints
+        regs = self.regs
+        tracer = self.tracer
+        while self.running and (maxSteps is None or self.steps < maxSteps):
+            tracer.Begin(regs.PC)
+            self.FetchAndDecode()
+            self.steps += 1
+            tracer.Record(regs.A, regs.F, self.cycles)
+            if self.pending and self.ProcessInterrupts():
+                tracer.Interrupt(regs.PC)
+                tracer.Record(regs.A, regs.F, self.cycles)
+            if self.cycles >= self.nextSync:
+                self.Sync()
+            if regs.PC in breakpoints:
+                self.breakAt = regs.PC
+                self.running = False
+
+    def StartTrace(self, capacity=trace_capacity, stream=None):
+        # Keeps the last capacity instructions; with a stream, all of them
+        # are written out as the ring fills and when a run ends
+        self.tracer = Tracer(self.bus, self.sizes, capacity, stream)
+        self.bus.SetWriteTrace(self.tracer.Write)
+        return self.tracer
+
+    def StopTrace(self):
+        tracer = self.tracer
+        if tracer is not None:
+            self.bus.SetWriteTrace(None)
+            tracer.Flush()
+            self.tracer = None
+        return tracer
+
+    def OnWatch(self, addr, access, value, stop):
+        # PC is already past the instruction that made the access
+        self.watchLog.append((self.regs.PC, addr, access, value))
+        if stop and self.running:
+            self.watchAt = (addr, access, value)
+            self.running = False
+
+    def EnableHistory(self, interval=snapshot_interval):
+        # Snapshots every interval cycles so execution can be stepped back
+        self.history = History(self, interval)
+        self.history.Take()
+        return self.history
+
+    def Position(self):
+        # Instructions executed since Reset, across runs and single steps
+        return self.stepBase + self.steps
+
+    def SetPosition(self, position):
+        self.stepBase = position - self.steps
+
+    def SaveState(self):
+        regs = self.regs
+        with self.pendingLock:
+            pending = (self.pending, dict(self.interrupters))
+        return ((regs.A, regs.B, regs.C, regs.D, regs.E, regs.H, regs.L, regs.F, regs.SP, regs.PC),
+                self.intMasks, self.intEnable, pending, self.intrVector, self.halted, self.cycles)
+
+    def RestoreState(self, state):
+        registers, self.intMasks, self.intEnable, pending, self.intrVector, self.halted, self.cycles = state
+        regs = self.regs
+        regs.A, regs.B, regs.C, regs.D, regs.E, regs.H, regs.L, regs.F, regs.SP, regs.PC = registers
+        with self.pendingLock:
+            self.pending, interrupters = pending
+            self.interrupters = dict(interrupters)
+
+    def Step(self):
+        # Single step from outside Run, counted for the history
+        if self.history is not None and self.cycles >= self.history.nextCycles:
+            self.history.Take()
+        self.SingleStep()
+        self.stepBase += 1
+
+    def SetBreakpoints(self, addrs):
+        # Picked up by the next Run; the loop is chosen when it starts
+        self.breakpoints = set(addr & 0xFFFF for addr in addrs)
+
+    def ToggleBreakpoint(self, addr):
+        addr &= 0xFFFF
+        if addr in self.breakpoints:
+            self.breakpoints.discard(addr)
+            return False
+        self.breakpoints.add(addr)
+        return True
+
+    def RunBlocks(self, maxSteps=None):
+        blocks = self.blocks
+        regs = self.regs
+        # Past last a whole block may not fit in maxSteps
+        last = no_sync if maxSteps is None else maxSteps - max_block_len
+        # Counted locally and stored back whenever something else can look
+        steps = self.steps
+        try:
+            while self.running and steps <= last:
+                block = blocks.get(regs.PC)
+                if block is None:
+                    block = self.Translate(regs.PC)
+                    if block is None:
+                        self.steps = steps
+                        self.SingleStep()
+                        steps += 1
+                        continue
+                try:
+                    steps += block()
+                except Exception:
+                    done, cycles = block.progress[self.instrPC]
+                    steps += done
+                    self.cycles += cycles
+                    raise
+                if self.pending:
+                    self.ProcessInterrupts()
+                if self.cycles >= self.nextSync:
+                    self.steps = steps
+                    self.Sync()
+        finally:
+            self.steps = steps
+        self.RunSteps(maxSteps)
     
     def Fetch(self):
-        pc = self.GetPC()
-        self.SetPC(pc+1)
-        byte = self.bus.ReadMemory(pc)
-        if byte > 0xFF:
-            self.SetPC(pc)
-            raise Exception("Invalid byte at: " + hex(byte))
-        return byte
+        pc = self.regs.PC
+        self.regs.PC = pc+1
+        return self.bus.PeekMemory(pc)
+
+    def Imm(self, handler):
+        handler(self.Fetch())
+
+    def Word(self, handler):
+        byteL = self.Fetch()
+        byteH = self.Fetch()
+        handler((byteH << 8) | byteL)
 
     def ProcessInterrupts(self):
-        if not self.intEnable:
-            return
-        if self.interrupt == -1:
-            return
+        # Returns True if an interrupt was accepted
+        with self.pendingLock:
+            pending = self.pending
+            if not pending & int_trap:
+                if not self.intEnable:
+                    return
+                pending &= ~self.intMasks | int_intr
+            if not pending:
+                return
+            if pending & int_trap:
+                bit, addr = int_trap, 0x0024
+            elif pending & int_rst75:
+                bit, addr = int_rst75, 0x003C
+            elif pending & int_rst65:
+                bit, addr = int_rst65, 0x0034
+            elif pending & int_rst55:
+                bit, addr = int_rst55, 0x002C
+            else:
+                bit, addr = int_intr, self.intrVector
+            self.pending &= ~bit
+            interrupter = self.interrupters.pop(bit, None)
         self.Di()
-        if not self.interrupter is None:
-            self.interrupter.Inta()
-            self.interrupter = None
-        self.Rst(self.interrupt*8+0x002C)
-        self.interrupt = -1
+        if not interrupter is None:
+            interrupter.Inta()
+        self.cycles += self.cycleTable[0xC7]
+        self.Rst(addr)
+        return True
 
     
     def GetData(self, reg):
         if reg == 'M':
             return self.bus.ReadMemory(self.alu.GetHL())
-        return self.alu.registers[reg]
+        return getattr(self.regs, reg)
 
     def SetData(self, reg, data):
         if reg == 'M':
             self.bus.WriteMemory(self.alu.GetHL(), data)
         else:
-            self.alu.registers[reg] = data
+            setattr(self.regs, reg, data)
 
-    def Mvi(self):
-        reg = mvi_map[self.opcode]
-        byte = self.Fetch()
+    def Mvi(self, reg, byte):
         self.SetData(reg, byte)
 
-    def Inr(self):
-        reg = mvi_map[self.opcode+2]
-        self.alu.Inr(reg)
+    def Inr(self, reg):
+        self.SetData(reg, self.alu.Increment(self.GetData(reg)))
 
-    def Inx(self):
-        reg = lxi_map[self.opcode-2]
+    def Inx(self, reg):
         self.alu.Inx(reg)
 
-    def Dcr(self):
-        reg = mvi_map[self.opcode+1]
-        self.alu.Dcr(reg)
+    def Dcr(self, reg):
+        self.SetData(reg, self.alu.Decrement(self.GetData(reg)))
 
-    def Dcx(self):
-        reg = lxi_map[self.opcode-0xA]
+    def Dcx(self, reg):
         self.alu.Dcx(reg)
 
-    def Lxi(self):
-        byteL = self.Fetch()
-        byteH = self.Fetch()
-        
-        regH = lxi_map[self.opcode]
+    def Lxi(self, regH, word):
         if regH == 'SP':
-            self.SetData(regH, (byteH << 8) | byteL)
+            self.SetData(regH, word)
         else:
             regL = regPair[regH]
-            self.SetData(regH, byteH)
-            self.SetData(regL, byteL)
+            self.SetData(regH, word >> 8)
+            self.SetData(regL, word & 0xFF)
 
-    def Mov(self):
-        dreg = mov_map[aux_word]
-        sreg = regOffset[self.opcode-aux_word]
+    def Mov(self, dreg, sreg):
         self.SetData(dreg, self.GetData(sreg))
-        
 
-    def Adi(self, carry=False):
-        byte = self.Fetch()
+    def Adi(self, byte, carry=False):
         self.alu.Add(byte, carry)
 
-    def Add(self, carry=False):
-        sreg = regOffset[self.opcode-aux_word]
+    def Add(self, sreg, carry=False):
         self.alu.Add(self.GetData(sreg), carry)
 
-    def Sbi(self, burrow=False):
-        byte = self.Fetch()
+    def Sbi(self, byte, burrow=False):
         self.alu.Sub(byte, burrow)
 
-    def Sub(self, burrow=False):
-        sreg = regOffset[self.opcode-aux_word]
-        self.alu.Add(self.GetData(sreg), burrow)
+    def Sub(self, sreg, burrow=False):
+        self.alu.Sub(self.GetData(sreg), burrow)
 
-    def Ani(self):
-        byte = self.Fetch()
+    def Ani(self, byte):
         self.alu.And(byte)
 
-    def Ana(self):
-        sreg = regOffset[self.opcode-aux_word]
+    def Ana(self, sreg):
         self.alu.And(self.GetData(sreg))
 
-    def Xri(self):
-        byte = self.Fetch()
+    def Xri(self, byte):
         self.alu.Xor(byte)
 
-    def Xra(self):
-        sreg = regOffset[self.opcode-aux_word]
+    def Xra(self, sreg):
         self.alu.Xor(self.GetData(sreg))
 
-    def Ori(self):
-        byte = self.Fetch()
+    def Ori(self, byte):
         self.alu.Or(byte)
 
-    def Ora(self):
-        sreg = regOffset[self.opcode-aux_word]
+    def Ora(self, sreg):
         self.alu.Or(self.GetData(sreg))
     
-    def Cmp(self):
-        sreg = regOffset[self.opcode-aux_word]
+    def Cmp(self, sreg):
         self.alu.Compare(self.GetData(sreg))
 
-    def Cpi(self):
-        byte = self.Fetch()
+    def Cpi(self, byte):
         self.alu.Compare(byte)
 
-    def Out(self):
-        byte = self.Fetch()
-        self.bus.WriteIO(byte, self.alu.registers['A'])
+    def Out(self, byte):
+        self.bus.WriteIO(byte, self.regs.A)
 
-    def In(self):
-        byte = self.Fetch()
-        self.alu.registers['A'] = self.bus.ReadIO(byte)
+    def In(self, byte):
+        self.regs.A = self.bus.ReadIO(byte)
 
     def PushBytes(self, hByte, lByte):
-        self.alu.registers['SP'] -= 1
-        self.bus.WriteMemory(self.alu.registers['SP'], hByte)
-        self.alu.registers['SP'] -= 1
-        self.bus.WriteMemory(self.alu.registers['SP'], lByte)
+        self.regs.SP -= 1
+        self.bus.WriteMemory(self.regs.SP, hByte)
+        self.regs.SP -= 1
+        self.bus.WriteMemory(self.regs.SP, lByte)
 
     def PopBytes(self):
-        low = self.bus.ReadMemory(self.alu.registers['SP'])
-        self.alu.registers['SP'] += 1
-        high = self.bus.ReadMemory(self.alu.registers['SP'])
-        self.alu.registers['SP'] += 1
+        low = self.bus.ReadMemory(self.regs.SP)
+        self.regs.SP += 1
+        high = self.bus.ReadMemory(self.regs.SP)
+        self.regs.SP += 1
         return high, low
 
-    def Push(self):
-        regH = push_map[self.opcode]
+    def Push(self, regH):
         regL = regPair[regH]
-        self.PushBytes(self.alu.registers[regH], self.alu.registers[regL])
+        self.PushBytes(getattr(self.regs, regH), getattr(self.regs, regL))
 
-    def Pop(self):
-        regH = pop_map[self.opcode]
+    def Pop(self, regH):
         regL = regPair[regH]
         high, low = self.PopBytes()
-        self.alu.registers[regL] = low
-        self.alu.registers[regH] = high
+        setattr(self.regs, regL, low)
+        setattr(self.regs, regH, high)
 
     def Sim(self):
-        acc = self.alu.registers['A']
+        acc = self.regs.A
         if acc & 0x08 == 0x08:
             self.intMasks = (self.intMasks & 0xF8) | (acc & 0x07)
+        if acc & 0x10 == 0x10:
+            with self.pendingLock:
+                self.pending &= ~int_rst75
+
+    def Rim(self):
+        acc = self.intMasks & 0x07
+        if self.intEnable:
+            acc |= 0x08
+        acc |= (self.pending & 0x07) << 4
+        self.regs.A = acc
 
     def Ei(self):
         self.intEnable = True
@@ -243,23 +604,59 @@ class CU:
         high, low = self.PopBytes()
         self.SetPC((high << 8) | low)
     
-    def Jmp(self):
-        adL = self.Fetch()
-        adH = self.Fetch()
-        addr = (adH << 8) | adL
+    def Jmp(self, addr):
         self.SetPC(addr)
 
-    def Lda(self):
-        adL = self.Fetch()
-        adH = self.Fetch()
-        addr = (adH << 8) | adL
-        self.alu.registers['A'] = self.bus.ReadMemory(addr)
+    def Pchl(self):
+        self.SetPC(self.alu.GetHL())
+
+    def Lda(self, addr):
+        self.regs.A = self.bus.ReadMemory(addr)
+
+    def Sta(self, addr):
+        self.bus.WriteMemory(addr, self.regs.A)
+
+    def Lhld(self, addr):
+        self.regs.L = self.bus.ReadMemory(addr)
+        self.regs.H = self.bus.ReadMemory(addr+1)
+
+    def Shld(self, addr):
+        self.bus.WriteMemory(addr, self.regs.L)
+        self.bus.WriteMemory(addr+1, self.regs.H)
+
+    def Ldax(self, getAddr):
+        self.regs.A = self.bus.ReadMemory(getAddr())
+
+    def Stax(self, getAddr):
+        self.bus.WriteMemory(getAddr(), self.regs.A)
+
+    def Xchg(self):
+        tmp = self.alu.GetDE()
+        self.alu.SetDE(self.alu.GetHL())
+        self.alu.SetHL(tmp)
 
-    def Sta(self):
-        adL = self.Fetch()
-        adH = self.Fetch()
-        addr = (adH << 8) | adL
-        self.bus.WriteMemory(addr, self.alu.registers['A'])
+    def Xthl(self):
+        data1 = self.bus.ReadMemory(self.regs.SP)
+        data2 = self.bus.ReadMemory(self.regs.SP+1)
+        self.bus.WriteMemory(self.regs.SP, self.regs.L)
+        self.bus.WriteMemory(self.regs.SP+1, self.regs.H)
+        self.regs.L = data1
+        self.regs.H = data2
+
+    def Sphl(self):
+        self.regs.SP = self.alu.GetHL()
+
+    def Dad(self, reg):
+        if reg == 'SP':
+            self.alu.DoubleAddition(self.regs.SP)
+        else:
+            self.alu.DoubleAddition((getattr(self.regs, reg) << 8) | getattr(self.regs, regPair[reg]))
+
+    def Stc(self):
+        self.alu.SetCarry(True)
+
+    def Cmc(self):
+        self.alu.SetCarry(not self.alu.GetCarry())
 
     def Cnd(self, cnd):
         if cnd == 'NZ':
@@ -280,189 +677,412 @@ class CU:
             return self.alu.GetSign()
         return False
 
-    def JmpCnd(self):
-        if not self.Cnd(cnd_map[self.opcode]):
-            self.Fetch()
-            self.Fetch()
+    def JmpCnd(self, cnd, addr):
+        if not self.Cnd(cnd):
             return
-        self.Jmp()
+        self.cycles += 3
+        self.Jmp(addr)
 
-    def Call(self):
-        pc = self.GetPC() + 2
+    def Call(self, addr):
+        pc = self.GetPC()
         self.PushBytes((pc & 0xFF00) >> 8, pc & 0x00FF)
-        self.Jmp()
+        self.Jmp(addr)
 
 
-    def CallCnd(self):
-        if not self.Cnd(cnd_map[self.opcode - 2]):
-            self.Fetch()
-            self.Fetch()
+    def CallCnd(self, cnd, addr):
+        if not self.Cnd(cnd):
             return
-        self.Call()
+        self.cycles += 9
+        self.Call(addr)
 
-    def RetCnd(self):
-        if not self.Cnd(cnd_map[self.opcode + 2]):
+    def RetCnd(self, cnd):
+        if not self.Cnd(cnd):
             return
+        self.cycles += 6
         self.Ret()
 
     def Hlt(self):
         self.SetPC(self.GetPC()-1)
         self.running = False
+        self.halted = True
+
+    def Nop(self):
+        pass
+
+    def Invalid(self, byte):
+        raise Exception("Invalid opcode: " + hex(byte))
+
+    def BuildTable(self):
+        handlers = [ None ] * 256
+        sizes = [ 1 ] * 256
+        for op in range(256):
+            handlers[op] = partial(self.Invalid, op)
+        handlers[0x00] = self.Nop
+
+        for op, reg in mvi_map.items():
+            handlers[op] = partial(self.Mvi, reg)
+            sizes[op] = 2
+            handlers[op-2] = partial(self.Inr, reg)
+            handlers[op-1] = partial(self.Dcr, reg)
+        for op, reg in lxi_map.items():
+            handlers[op] = partial(self.Lxi, reg)
+            sizes[op] = 3
+            handlers[op+2] = partial(self.Inx, reg)
+            handlers[op+0xA] = partial(self.Dcx, reg)
+        for op, reg in dad_map.items():
+            handlers[op] = partial(self.Dad, reg)
+        for op, reg in push_map.items():
+            handlers[op] = partial(self.Push, reg)
+        for op, reg in pop_map.items():
+            handlers[op] = partial(self.Pop, reg)
+        for base, dreg in mov_map.items():
+            for i, sreg in enumerate(regOffset):
+                handlers[base+i] = partial(self.Mov, dreg, sreg)
+        handlers[0x76] = self.Hlt
+
+        for i, sreg in enumerate(regOffset):
+            handlers[0x80+i] = partial(self.Add, sreg)
+            handlers[0x88+i] = partial(self.Add, sreg, True)
+            handlers[0x90+i] = partial(self.Sub, sreg)
+            handlers[0x98+i] = partial(self.Sub, sreg, True)
+            handlers[0xA0+i] = partial(self.Ana, sreg)
+            handlers[0xA8+i] = partial(self.Xra, sreg)
+            handlers[0xB0+i] = partial(self.Ora, sreg)
+            handlers[0xB8+i] = partial(self.Cmp, sreg)
+
+        handlers[0xC6] = self.Adi
+        handlers[0xCE] = partial(self.Adi, carry=True)
+        handlers[0xD6] = self.Sbi
+        handlers[0xDE] = partial(self.Sbi, burrow=True)
+        handlers[0xE6] = self.Ani
+        handlers[0xEE] = self.Xri
+        handlers[0xF6] = self.Ori
+        handlers[0xFE] = self.Cpi
+        handlers[0xDB] = self.In
+        handlers[0xD3] = self.Out
+        for op in [ 0xC6, 0xCE, 0xD6, 0xDE, 0xE6, 0xEE, 0xF6, 0xFE, 0xDB, 0xD3 ]:
+            sizes[op] = 2
+
+        handlers[0xF3] = self.Di
+        handlers[0xFB] = self.Ei
+        handlers[0x20] = self.Rim
+        handlers[0x30] = self.Sim
+
+        handlers[0x3A] = self.Lda
+        handlers[0x32] = self.Sta
+        handlers[0x2A] = self.Lhld
+        handlers[0x22] = self.Shld
+        handlers[0x0A] = partial(self.Ldax, self.alu.GetBC)
+        handlers[0x1A] = partial(self.Ldax, self.alu.GetDE)
+        handlers[0x02] = partial(self.Stax, self.alu.GetBC)
+        handlers[0x12] = partial(self.Stax, self.alu.GetDE)
+        handlers[0xEB] = self.Xchg
+        handlers[0xE3] = self.Xthl
+        handlers[0xF9] = self.Sphl
+
+        handlers[0x2F] = self.alu.Not
+        handlers[0x37] = self.Stc
+        handlers[0x3F] = self.Cmc
+        handlers[0x27] = self.alu.DecimalAdjust
+        handlers[0x07] = self.alu.Rlc
+        handlers[0x0F] = self.alu.Rrc
+        handlers[0x17] = self.alu.Ral
+        handlers[0x1F] = self.alu.Rar
+
+        handlers[0xC9] = self.Ret
+        handlers[0xC3] = self.Jmp
+        handlers[0xCD] = self.Call
+        handlers[0xE9] = self.Pchl
+        for op, cnd in cnd_map.items():
+            handlers[op] = partial(self.JmpCnd, cnd)
+            handlers[op+2] = partial(self.CallCnd, cnd)
+            handlers[op-2] = partial(self.RetCnd, cnd)
+        for i, op in enumerate(rst_map):
+            handlers[op] = partial(self.Rst, i*8)
+        for op in [ 0x3A, 0x32, 0x2A, 0x22, 0xC3, 0xCD ] + [ op+k for op in cnd_map for k in (0, 2) ]:
+            sizes[op] = 3
+
+        table = list(handlers)
+        for op in range(256):
+            if sizes[op] == 2:
+                table[op] = partial(self.Imm, handlers[op])
+            elif sizes[op] == 3:
+                table[op] = partial(self.Word, handlers[op])
+
+        self.handlers = handlers
+        self.sizes = sizes
+        self.table = table
+        self.cycleTable = self.BuildCycleTable()
+
+    def BuildCycleTable(self):
+        cycles = [ 4 ] * 256
+        for op, reg in mvi_map.items():
+            cycles[op] = 10 if reg == 'M' else 7
+            cycles[op-2] = 10 if reg == 'M' else 4
+            cycles[op-1] = 10 if reg == 'M' else 4
+        for op in lxi_map:
+            cycles[op] = 10
+            cycles[op+2] = 6
+            cycles[op+0xA] = 6
+        for op in dad_map:
+            cycles[op] = 10
+        for op in push_map:
+            cycles[op] = 12
+        for op in pop_map:
+            cycles[op] = 10
+        for base, dreg in mov_map.items():
+            for i, sreg in enumerate(regOffset):
+                cycles[base+i] = 7 if 'M' in (dreg, sreg) else 4
+        cycles[0x76] = 5
+        for i, sreg in enumerate(regOffset):
+            for base in range(0x80, 0xC0, 8):
+                cycles[base+i] = 7 if sreg == 'M' else 4
+        for op in [ 0xC6, 0xCE, 0xD6, 0xDE, 0xE6, 0xEE, 0xF6, 0xFE, 0x0A, 0x1A, 0x02, 0x12 ]:
+            cycles[op] = 7
+        for op in [ 0xDB, 0xD3, 0xC9, 0xC3 ]:
+            cycles[op] = 10
+        for op in [ 0x3A, 0x32 ]:
+            cycles[op] = 13
+        for op in [ 0x2A, 0x22, 0xE3 ]:
+            cycles[op] = 16
+        for op in [ 0xF9, 0xE9 ]:
+            cycles[op] = 6
+        cycles[0xCD] = 18
+        for op in cnd_map:
+            cycles[op] = 7
+            cycles[op+2] = 9
+            cycles[op-2] = 6
+        for op in rst_map:
+            cycles[op] = 12
+        return cycles
+
+    def Translate(self, start):
+        bus = self.bus
+        ns = { 'R':self.regs, 'cu':self, 'rd':bus.ReadMemory, 'wr':bus.WriteMemory,
+               'rp':bus.pageReads, 'wp':bus.pageWrites, 'code':bus.codeMap, 'inval':bus.codeWriteHandler,
+               'add':add_table, 'sub':sub_table, 'szp':szp_table }
+        lines = [ "def Block():" ]
+        # instrPC -> (instructions before it, cycles up to and including it)
+        # for every instruction that can raise, so a fault is counted as in RunSteps
+        progress = {}
+        addr = start
+        count = 0
+        cycles = 0
+        op = None
+        ended = False
+        stores = False
+        while count < max_block_len:
+            try:
+                op = bus.PeekMemory(addr)
+                size = self.sizes[op]
+                operand = None
+                if size == 2:
+                    operand = bus.PeekMemory(addr+1)
+                elif size == 3:
+                    operand = bus.PeekMemory(addr+1) | (bus.PeekMemory(addr+2) << 8)
+            except Exception:
+                break
+            nxt = addr + size
+            count += 1
+            cycles += self.cycleTable[op]
+
+            code = self.InlineSource(op, operand)
+            jumps = op in branch_ops
+            if code is None and jumps:
+                code = self.BranchSource(op, operand, nxt, count, cycles)
+                if code is not None and op in cond_ops:
+                    jumps = False
+                else:
+                    ended = code is not None
+            handler = code is None and op != 0x00
+            if handler:
+                name = 'h%d' % count
+                ns[name] = self.handlers[op]
+                code = [ "%s()" % name if operand is None else "%s(%d)" % (name, operand) ]
+            touches = handler or code and any(m in line for line in code for m in memory_source)
+            if touches:
+                # Handlers and memory accesses can raise, and watchpoints
+                # log PC, so these see the same state as in RunSteps
+                lines.append("    cu.instrPC = %d" % addr)
+                progress[addr] = (count - 1, cycles)
+                lines.append("    R.PC = %d" % nxt)
+            lines += [ "    " + line for line in code or () ]
+            exits = []
+            if op in store_ops:
+                if not stores:
+                    # DropBlock sets the flag; only blocks that check it clear it
+                    lines.insert(1, "    cu.stale = False")
+                    stores = True
+                exits.append("cu.stale")
+            if touches and not jumps and op not in cond_ops:
+                # A stopping watchpoint clears running; stop right after
+                # the instruction, as RunSteps does
+                exits.append("not cu.running")
+            if exits:
+                lines.append("    if %s:" % " or ".join(exits))
+                lines.append("        cu.cycles += %d" % cycles)
+                lines.append("        return %d" % count)
+            addr = nxt
+            if jumps or nxt > 0xFFFF:
+                break
+        if count == 0:
+            return None
+        if not ended:
+            if not jumps:
+                lines.append("    R.PC = %d" % addr)
+            lines.append("    cu.cycles += %d" % cycles)
+            lines.append("    return %d" % count)
+
+        exec(compile("\n".join(lines), "<block %04x>" % start, "exec"), ns)
+        block = ns['Block']
+        block.progress = progress
+        end = addr - 1
+        self.blocks[start] = block
+        self.blockEnds[start] = end
+        for page in range(start >> 8, (end >> 8) + 1):
+            self.blockPages.setdefault(page, set()).add(start)
+        self.bus.MarkCode(start, end)
+        return block
+
+    def InlineSource(self, op, operand):
+        # Statements that do what the handler for op does, for the common
+        # opcodes that don't end a block; None leaves it to the handler
+        hl = "(R.H << 8) | R.L"
+        if 0x40 <= op < 0x80 and op != 0x76:
+            dreg = regOffset[(op >> 3) & 0x07]
+            if dreg == 'M':
+                return [ "m = " + hl ] + WriteSource("R.H", "m", reg_source[op & 0x07])
+            return [ "R.%s = %s" % (dreg, reg_source[op & 0x07]) ]
+        if 0x80 <= op < 0xC0:
+            return [ line.format(reg_source[op & 0x07]) for line in alu_source[(op - 0x80) >> 3] ]
+        if op & 0xC7 == 0xC6:
+            return [ line.format(operand) for line in alu_source[(op - 0xC6) >> 3] ]
+        if op in mvi_map:
+            if mvi_map[op] == 'M':
+                return [ "m = " + hl ] + WriteSource("R.H", "m", operand)
+            return [ "R.%s = %d" % (mvi_map[op], operand) ]
+        if op + 2 in mvi_map or op + 1 in mvi_map:
+            table = 'add' if op + 2 in mvi_map else 'sub'
+            reg = mvi_map[op + 2] if op + 2 in mvi_map else mvi_map[op + 1]
+            flags = "R.F = (R.F & 0x01) | ((v >> 8) & ~0x01)"
+            if reg == 'M':
+                return [ "m = " + hl, "v = %s[(rp[R.H](m) << 8) | 1]" % table, flags ] + WriteSource("R.H", "m", "v & 0xFF")
+            return [ "v = %s[(R.%s << 8) | 1]" % (table, reg), "R.%s = v & 0xFF" % reg, flags ]
+        if op in lxi_map:
+            if lxi_map[op] == 'SP':
+                return [ "R.SP = %d" % operand ]
+            return [ "R.%s = %d" % (lxi_map[op], operand >> 8), "R.%s = %d" % (regPair[lxi_map[op]], operand & 0xFF) ]
+        if op - 2 in lxi_map or op - 0xA in lxi_map:
+            step = "+ 1" if op - 2 in lxi_map else "- 1"
+            regH = lxi_map[op - 2] if op - 2 in lxi_map else lxi_map[op - 0xA]
+            if regH == 'SP':
+                return [ "R.SP = (R.SP %s) & 0xFFFF" % step ]
+            regL = regPair[regH]
+            return [ "v = ((R.%s << 8) | R.%s) %s" % (regH, regL, step), "R.%s = (v >> 8) & 0xFF" % regH, "R.%s = v & 0xFF" % regL ]
+        if op in dad_map:
+            reg = dad_map[op]
+            value = "R.SP" if reg == 'SP' else "((R.%s << 8) | R.%s)" % (reg, regPair[reg])
+            return [ "v = (%s) + %s" % (hl, value), "R.H = (v >> 8) & 0xFF", "R.L = v & 0xFF",
+                     "R.F = (R.F | 0x01) if v > 0xFFFF else (R.F & ~0x01)" ]
+        if op in push_map:
+            regH = push_map[op]
+            return [ "R.SP -= 1", "wr(R.SP, R.%s)" % regH, "R.SP -= 1", "wr(R.SP, R.%s)" % regPair[regH] ]
+        if op in pop_map:
+            regH = pop_map[op]
+            return [ "lo = rd(R.SP)", "R.SP += 1", "hi = rd(R.SP)", "R.SP += 1",
+                     "R.%s = lo" % regPair[regH], "R.%s = hi" % regH ]
+        if op == 0x3A:
+            return [ "R.A = rp[%d](%d)" % (operand >> 8, operand) ]
+        if op == 0x32:
+            return WriteSource(operand >> 8, operand, "R.A")
+        if op == 0x2A and operand < 0xFFFF:
+            return [ "R.L = rp[%d](%d)" % (operand >> 8, operand), "R.H = rp[%d](%d)" % ((operand + 1) >> 8, operand + 1) ]
+        if op == 0x22 and operand < 0xFFFF:
+            return WriteSource(operand >> 8, operand, "R.L") + WriteSource((operand + 1) >> 8, operand + 1, "R.H")
+        if op in (0x0A, 0x1A):
+            regH, regL = ('B', 'C') if op == 0x0A else ('D', 'E')
+            return [ "R.A = rp[R.%s]((R.%s << 8) | R.%s)" % (regH, regH, regL) ]
+        if op in (0x02, 0x12):
+            regH, regL = ('B', 'C') if op == 0x02 else ('D', 'E')
+            return [ "m = (R.%s << 8) | R.%s" % (regH, regL) ] + WriteSource("R." + regH, "m", "R.A")
+        if op == 0xEB:
+            return [ "R.D, R.E, R.H, R.L = R.H, R.L, R.D, R.E" ]
+        if op == 0xF9:
+            return [ "R.SP = " + hl ]
+        if op == 0x2F:
+            return [ "R.A ^= 0xFF" ]
+        if op == 0x37:
+            return [ "R.F |= 0x01" ]
+        if op == 0x3F:
+            return [ "R.F ^= 0x01" ]
+        if op == 0x07:
+            return [ "a = R.A", "R.A = ((a << 1) | (a >> 7)) & 0xFF", "R.F = (R.F & ~0x01) | (a >> 7)" ]
+        if op == 0x0F:
+            return [ "a = R.A", "R.A = (a >> 1) | ((a & 0x01) << 7)", "R.F = (R.F & ~0x01) | (a & 0x01)" ]
+        if op == 0x17:
+            return [ "a = R.A", "R.A = ((a << 1) | (R.F & 0x01)) & 0xFF", "R.F = (R.F & ~0x01) | (a >> 7)" ]
+        if op == 0x1F:
+            return [ "a = R.A", "R.A = (a >> 1) | ((R.F & 0x01) << 7)", "R.F = (R.F & ~0x01) | (a & 0x01)" ]
+        return None
+
+    def BranchSource(self, op, operand, nxt, count, cycles):
+        # Statements for a jump, call or return. Unconditional ones end the
+        # block; conditional ones return only when taken and otherwise fall
+        # through. As in the handlers, a taken one adds its extra cycles
+        # before touching the stack. None leaves it to the handler
+        done = [ "cu.cycles += %d" % cycles, "return %d" % count ]
+        ret = [ "lo = rd(R.SP)", "R.SP += 1", "hi = rd(R.SP)", "R.SP += 1", "R.PC = (hi << 8) | lo" ]
+        if op == 0xC9:
+            return ret + done
+        if op == 0xE9:
+            return [ "R.PC = (R.H << 8) | R.L" ] + done
+        if op + 2 in cnd_map:
+            taken = [ "cu.cycles += 6" ] + ret + done
+            return [ "if %s:" % cnd_source[cnd_map[op + 2]] ] + [ "    " + line for line in taken ]
+        if operand is None:
+            return None
+        call = [ "R.SP -= 1", "wr(R.SP, %d)" % ((nxt & 0xFF00) >> 8), "R.SP -= 1", "wr(R.SP, %d)" % (nxt & 0xFF),
+                 "R.PC = %d" % operand ]
+        if op == 0xC3:
+            return [ "R.PC = %d" % operand ] + done
+        if op == 0xCD:
+            return call + done
+        if op in cnd_map:
+            taken = [ "R.PC = %d" % operand, "cu.cycles += %d" % (cycles + 3), "return %d" % count ]
+            return [ "if %s:" % cnd_source[cnd_map[op]] ] + [ "    " + line for line in taken ]
+        if op - 2 in cnd_map:
+            taken = [ "cu.cycles += 9" ] + call + done
+            return [ "if %s:" % cnd_source[cnd_map[op - 2]] ] + [ "    " + line for line in taken ]
+        return None
+
+    def InvalidateCode(self, addr):
+        for start in list(self.blockPages.get(addr >> 8, ())):
+            if start <= addr <= self.blockEnds.get(start, -1):
+                self.DropBlock(start)
+
+    def DropBlock(self, start):
+        end = self.blockEnds.pop(start, None)
+        if end is None:
+            return
+        self.blocks.pop(start, None)
+        for page in range(start >> 8, (end >> 8) + 1):
+            self.blockPages[page].discard(start)
+        self.stale = True
+
+    def FlushBlocks(self):
+        self.blocks.clear()
+        self.blockEnds.clear()
+        self.blockPages.clear()
+        self.bus.ClearCode()
+        self.stale = True
 
     def SingleStep(self):
         self.FetchAndDecode()
         self.ProcessInterrupts()
 
     def FetchAndDecode(self):
-        byte = self.Fetch()
-        self.opcode = byte
-        if byte == 0x00:
-            pass
-        elif byte == 0x76:
-            self.Hlt()
-        elif byte in mvi_map:
-            self.Mvi()
-        elif byte+2 in mvi_map:
-            self.Inr()
-        elif byte+1 in mvi_map:
-            self.Dcr()
-        elif byte-2 in lxi_map:
-            self.Inx()
-        elif byte-0xA in lxi_map:
-            self.Dcx()
-        elif byte in lxi_map:
-            self.Lxi()
-        elif byte in push_map:
-            self.Push()
-        elif byte in pop_map:
-            self.Pop()
-        elif CheckMov(byte):
-            self.Mov()
-        elif byte == 0xC6:
-            self.Adi()
-        elif byte == 0xCE:
-            self.Adi(True)
-        elif CheckOffset(byte, 0x80):
-            self.Add()
-        elif CheckOffset(byte, 0x88):
-            self.Add(True)
-        elif byte == 0xD6:
-            self.Sbi()
-        elif byte == 0xDE:
-            self.Sbi(True)
-        elif CheckOffset(byte, 0x90):
-            self.Sub()
-        elif CheckOffset(byte, 0x98):
-            self.Sub(True)
-        elif byte == 0xE6:
-            self.Ani()
-        elif CheckOffset(byte, 0xA0):
-            self.Ana()
-        elif byte == 0xF6:
-            self.Ori()
-        elif CheckOffset(byte, 0xB0):
-            self.Ora()
-        elif byte == 0xEE:
-            self.Xri()
-        elif CheckOffset(byte, 0xA8):
-            self.Xra()
-        elif byte == 0xFE:
-            self.Cpi()
-        elif CheckOffset(byte, 0xB8):
-            self.Cmp()
-        elif byte == 0xDB:
-            self.In()
-        elif byte == 0xD3:
-            self.Out()
-        elif byte == 0xF3:
-            self.Di()
-        elif byte == 0xFB:
-            self.Ei()
-        elif byte == 0x30:
-            self.Sim()
-        elif byte == 0xC9:
-            self.Ret()
-        elif byte == 0x3A:
-            self.Lda()
-        elif byte == 0x32:
-            self.Sta()
-        elif byte == 0xEB:
-            tmp = self.alu.GetDE()
-            self.alu.SetDE(self.alu.GetHL())
-            self.alu.SetHL(tmp)
-        elif byte == 0x0A:
-            data = self.bus.ReadMemory(self.alu.GetBC())
-            self.alu.registers['A'] = data
-        elif byte == 0x1A:
-            data = self.bus.ReadMemory(self.alu.GetDE())
-            self.alu.registers['A'] = data
-        elif byte == 0x02:
-            data = self.alu.registers['A']
-            self.bus.WriteMemory(self.alu.GetBC(), data)
-        elif byte == 0x12:
-            data = self.alu.registers['A']
-            self.bus.WriteMemory(self.alu.GetDE(), data)
-        elif byte == 0x22:
-            byteL = self.Fetch()
-            byteH = self.Fetch()
-            addr = (byteH << 8) | byteL
-            self.bus.WriteMemory(addr, self.alu.registers['L'])
-            self.bus.WriteMemory(addr+1, self.alu.registers['H'])
-        elif byte == 0x2A:
-            byteL = self.Fetch()
-            byteH = self.Fetch()
-            addr = (byteH << 8) | byteL
-            dataL = self.bus.ReadMemory(addr)
-            dataH = self.bus.ReadMemory(addr+1)
-            self.alu.registers['L'] = dataL
-            self.alu.registers['H'] = dataH
-        elif byte == 0x2F:
-            self.alu.Not()
-        elif byte == 0x37:
-            self.alu.SetCarry(True)
-        elif byte == 0x3F:
-            self.alu.SetCarry(not self.alu.GetCarry())
-        elif byte == 0x27:
-            self.alu.DecimalAdjust()
-        elif byte == 0xE3:
-            data1 = self.bus.ReadMemory(self.alu.registers['SP'])
-            data2 = self.bus.ReadMemory(self.alu.registers['SP']+1)
-            self.bus.WriteMemory(self.alu.registers['SP'], self.alu.registers['L'])
-            self.bus.WriteMemory(self.alu.registers['SP']+1, self.alu.registers['H'])
-            self.alu.registers['L'] = data1
-            self.alu.registers['H'] = data2
-        elif byte == 0x09:
-            self.alu.DoubleAddition(self.alu.GetBC())
-        elif byte == 0x19:
-            self.alu.DoubleAddition(self.alu.GetDE())
-        elif byte == 0x29:
-            self.alu.DoubleAddition(self.alu.GetHL())
-        elif byte == 0x39:
-            self.alu.DoubleAddition(self.alu.registers['SP'])
-        elif byte == 0xF9:
-            self.alu.registers['SP'] = self.alu.GetHL()
-        elif byte == 0x07:
-            self.alu.Rlc()
-        elif byte == 0x0F:
-            self.alu.Rrc()
-        elif byte == 0x17:
-            self.alu.Ral()
-        elif byte == 0x1F:
-            self.alu.Rar()
-        elif (byte+2) in cnd_map:
-            self.RetCnd()
-        elif byte == 0xC3:
-            self.Jmp()
-        elif byte in cnd_map:
-            self.JmpCnd()
-        elif byte == 0xCD:
-            self.Call()
-        elif (byte-2) in cnd_map:
-            self.CallCnd()
-        elif byte in rst_map:
-            self.Rst(rst_map.index(byte) * 8)
-
-        else:
-            raise Exception("Invalid opcode: " + hex(byte))
-
-
+        # instrPC stays on the instruction being executed, for error reports
+        self.instrPC = self.regs.PC
+        self.opcode = self.Fetch()
+        self.cycles += self.cycleTable[self.opcode]
+        self.table[self.opcode]()
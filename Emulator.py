@@ -1,34 +1,30 @@
 #!/usr/bin/python3
 from gi.repository import Gtk, GObject, Gdk, GLib, Pango, Pango, GtkSource
 
-from ALU import ALU
-from CU import CU
-from RAM import RAM
-from Bus import Bus
-from PPI import PPI
-from Assembler import Assembler
+from Machine import Machine
+from Assembler import AssemblerSession
 from PPIWindow import PPIWindow
+from MemoryView import MemoryView
+from Loader import LoadAssembler
 
-from threading import Thread
-from functools import partial
-import re
+from collections import deque
+from threading import Lock
 import time
 from enum import Enum
 import sys, os
 
-bus = Bus()
-ram = RAM(0x0, 64)
-bus.AddMemoryPeripheral(ram, 0x0, 0x0+64*1024-1)
+refresh_rate = 20
+max_log_lines = 500
 
-alu = ALU()
-cu = CU(alu, bus)
+machine = Machine()
+bus = machine.bus
+ram = machine.ram
+alu = machine.alu
+cu = machine.cu
+cu.EnableHistory()
 
 def AddPPI(addr):
-    ppi = PPI(addr)
-    bus.AddIOPeripheral(ppi, addr, addr+3)
-    ppi.SetInterruptCallPA(partial(cu.RST, 5.5, ppi))
-    ppi.SetInterruptCallPB(partial(cu.RST, 6.5, ppi))
-    return ppi
+    return machine.AddPPI(addr)
 
    
 
@@ -39,25 +35,10 @@ class State(Enum):
     go = 3
     executing = 4
 
-def execute():
-    try:
-        cu.Run()
-    except Exception as ex:
-        win.Clear()
-        print()
-        print ("Error: ")
-        print ("=======")
-        print(ex)
-        print("\tat address: " + hex(alu.registers['PC']))
-        print()
-        cu.Reset()
-
-
-
 def WriteMemData(addr, data):
     bus.WriteMemory(addr, data)
 def GetMemData(addr):
-    return bus.ReadMemory(addr)
+    return bus.PeekMemory(addr)
 def GetRegData(reg):
     return alu.registers[reg]
 
@@ -72,20 +53,52 @@ def PrevReg(reg):
     return reglist[id]
 
 class Logger(object):
-    def __init__(self, label):
+    def __init__(self, label, logFile=None):
         self.msgbox = label
         self.terminal = sys.stdout
-        self.msg = ""
+        self.logFile = logFile
+        self.lines = deque(maxlen=max_log_lines)
+        self.partial = ""
+        self.lock = Lock()
+        self.scheduled = False
 
     def write(self, message):
         self.terminal.write(message)
-        self.msg += message
-        self.msgbox.set_text(self.msg)
+        if self.logFile:
+            self.logFile.write(message)
+        with self.lock:
+            parts = (self.partial + message).split('\n')
+            self.lines.extend(parts[:-1])
+            self.partial = parts[-1]
+            if self.scheduled:
+                return
+            self.scheduled = True
+        GLib.idle_add(self.Update)
+
+    def Update(self):
+        with self.lock:
+            self.scheduled = False
+            text = '\n'.join(self.lines)
+            if self.partial:
+                text += '\n' + self.partial if self.lines else self.partial
+            elif self.lines:
+                text += '\n'
+        self.msgbox.set_text(text)
+        if self.logFile:
+            self.logFile.flush()
+        return False
 
-    def flush(self):
-        self.msg = ""
+    def Clear(self):
+        with self.lock:
+            self.lines.clear()
+            self.partial = ""
         self.msgbox.set_text("")
 
+    def flush(self):
+        self.terminal.flush()
+        if self.logFile:
+            self.logFile.flush()
+
 class Window(Gtk.Window):
     def __init__(self):
         Gtk.Window.__init__(self,title="8085 Emulator")
@@ -221,6 +234,12 @@ class Window(Gtk.Window):
         self.textEditor = GtkSource.View.new_with_buffer(sbuffer) #Gtk.TextView()
         self.textEditor.set_left_margin(20)
         self.textEditor.override_font(Pango.font_description_from_string("Dejavu Sans Mono 11"))
+        # Clicking the gutter toggles a breakpoint on that line
+        self.textEditor.set_show_line_marks(True)
+        breakpointMark = GtkSource.MarkAttributes()
+        breakpointMark.set_icon_name("media-record")
+        self.textEditor.set_mark_attributes("breakpoint", breakpointMark, 1)
+        self.textEditor.connect('line-mark-activated', self.toggle_breakpoint)
         
         lman = GtkSource.LanguageManager.get_default()
         paths = lman.get_search_path()
@@ -242,12 +261,18 @@ class Window(Gtk.Window):
         exportfilebutton.connect('clicked', self.export_file)
         exportexfilebutton = Gtk.Button("Save asm with opcodes")
         exportexfilebutton.connect('clicked', self.export_ex_file)
+        exporthexbutton = Gtk.Button("Save HEX")
+        exporthexbutton.connect('clicked', self.export_hex_file)
+        exportbinbutton = Gtk.Button("Save BIN")
+        exportbinbutton.connect('clicked', self.export_bin_file)
 
         strip0 = Gtk.Box(spacing = 10)
         strip0.add(loadFileButton)
         strip0.add(savefilebutton)
         strip0.add(exportfilebutton)
         strip0.add(exportexfilebutton)
+        strip0.add(exporthexbutton)
+        strip0.add(exportbinbutton)
 
         loadLbl = Gtk.Label("Load Address: ")
         self.loadaddr = Gtk.Entry()
@@ -285,11 +310,17 @@ class Window(Gtk.Window):
         loadButton.connect('clicked', self.load_button)
         runButton = Gtk.Button("Load and Run")
         runButton.connect('clicked', self.run_button)
+        runBackButton = Gtk.Button("Run back")
+        runBackButton.connect('clicked', self.run_back_button)
+        realSpeedButton = Gtk.CheckButton("Real speed (3 MHz)")
+        realSpeedButton.connect('toggled', self.real_speed)
 
         strip.add(loadLbl)
         strip.add(self.loadaddr)
         strip.add(loadButton)
         strip.add(runButton)
+        strip.add(runBackButton)
+        strip.add(realSpeedButton)
         
         editorBox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
         editorBox.pack_start(strip0, False, True, 0)
@@ -320,42 +351,37 @@ class Window(Gtk.Window):
         extra_box.pack_start(strip2, False, True, 0)
         
         tablestrip = Gtk.Box(spacing=10)
-        lbl = Gtk.Label("Table: Start Address:")
+        lbl = Gtk.Label("Memory: Address:")
         self.tablestart = Gtk.Entry()
         self.tablestart.set_max_length(4)
         self.tablestart.set_alignment(1)
         self.tablestart.set_text('9000')
         tablestrip.add(lbl)
         tablestrip.add(self.tablestart)
-
-        lbl = Gtk.Label("Length:")
-        self.tableend = Gtk.Entry()
-        self.tableend.set_alignment(1)
-        self.tableend.set_text('10')
-        tablestrip.add(lbl)
-        tablestrip.add(self.tableend)
+        self.tablestart.connect("activate", self.table)
         
-        tablebutton = Gtk.Button("View Table")
+        tablebutton = Gtk.Button("Go")
         tablebutton.connect("clicked", self.table)
         tablestrip.add(tablebutton)
 
         parentBox.pack_start(tablestrip, False, True, 0)
-        self.tablelbl = Gtk.Label()
-        tableBox = Gtk.ScrolledWindow()
-        tableBox.add(self.tablelbl)
-        parentBox.pack_start(tableBox, False, True, 0)
+        self.memview = MemoryView(bus)
+        parentBox.pack_start(self.memview, True, True, 0)
         
         self.resize(1000, 400)
 
         self.focus_box = 0
         self.state = State.none
+        self.refresher = None
+        self.lastSnapshot = None
+        self.session = AssemblerSession()
         self.reset()
 
         self.ppis = []
 
         self.textEditor.grab_focus()
 
-        sys.stdout = Logger(self.notifier)
+        sys.stdout = Logger(self.notifier, logFile)
 
     def AddFilters(self, dialog):
         filter_asm = Gtk.FileFilter()
@@ -373,6 +399,7 @@ class Window(Gtk.Window):
         self.AddFilters(dialog)
         res = dialog.run()
         if res == Gtk.ResponseType.OK:
+            self.session.includePath = [ os.path.dirname(dialog.get_filename()) ]
             fp = open(dialog.get_filename(), 'r')
             string = fp.read()
             fp.close()
@@ -389,6 +416,7 @@ class Window(Gtk.Window):
         self.AddFilters(dialog)
         res = dialog.run()
         if res == Gtk.ResponseType.OK:
+            self.session.includePath = [ os.path.dirname(dialog.get_filename()) ]
             tb = self.textEditor.get_buffer()
             string = tb.get_text(tb.get_start_iter(), tb.get_end_iter(), False)
             fp = open(dialog.get_filename(), 'w')
@@ -403,6 +431,12 @@ class Window(Gtk.Window):
 
     def export_ex_file(self, w):
         self.ExportDialog(True)
+
+    def export_hex_file(self, w):
+        self.ExportDialog(format="hex")
+
+    def export_bin_file(self, w):
+        self.ExportDialog(format="bin")
       
     def add_ppi(self, w):
         ppi = {}
@@ -422,7 +456,7 @@ class Window(Gtk.Window):
 
     def remove_ppi(self, w, e):
         ppi = self.get_ppi(w)
-        bus.RemoveIOPeripheral(ppi["ppi"])
+        machine.RemovePPI(ppi["ppi"])
         self.ppis.remove(ppi)
     
     def run_button(self, w):
@@ -433,20 +467,14 @@ class Window(Gtk.Window):
     def load_button(self, w):
         tb = self.textEditor.get_buffer()
         string = tb.get_text(tb.get_start_iter(), tb.get_end_iter(), False)
-        asm = Assembler()
         try:
-            asm.Lex(string)
             try:
                 addr = int(self.loadaddr.get_text(), 16)
             except:
                 addr = 0
-            asm.Parse(addr)
-            for byte_list in asm.bytes_list:
-                ad = byte_list["address"]
-                i = 0
-                for byte in byte_list["bytes"]:
-                    ram.Write(ad+i, byte)
-                    i += 1
+            asm = self.session.Assemble(string, addr)
+            LoadAssembler(bus, asm)
+            self.memview.Refresh()
             
             strlbl = ""
             for lbl in asm.labels:
@@ -462,30 +490,20 @@ class Window(Gtk.Window):
             print ("Assembling Error: ")
             print ("=======")
             print(ex)
-            print("at line: \n\t" + asm.line + "\nline no.: " + str(asm.line_no))
+            print("at line: \n\t" + self.session.line + "\nline no.: " + str(self.session.line_no) +
+                  (" in " + self.session.file if self.session.file else ""))
             return False
            
     def Clear(self):
-        sys.stdout.flush()
+        sys.stdout.Clear()
 
     def table(self, w):
         try:
             saddr = int(self.tablestart.get_text(),16)
         except ValueError:
             saddr = 0
-        try:
-            length = int(self.tableend.get_text())
-        except ValueError:
-            length = 0
-        string = ""
-        i = 0
-        while i < length:
-            addr = saddr + i
-            data = '{:02x}'.format(GetMemData(addr))
-            addrs = '{:04x}'.format(addr)
-            string += "\t" + addrs + ": " + data
-            i += 1
-        self.tablelbl.set_text(string)
+        self.memview.Refresh()
+        self.memview.ScrollTo(saddr)
 
     def addr_focus(self, w, e):
         self.focus_box = 0
@@ -526,6 +544,8 @@ class Window(Gtk.Window):
                         self.entry_addr.set_text(reg)
                     elif self.singleStepping and input=="Next":
                         self.SingleStep()
+                    elif input=="Prev" and (self.singleStepping or cu.history.CanStepBack()):
+                        self.StepBack()
                         
                     self.change_data()
 
@@ -561,11 +581,35 @@ class Window(Gtk.Window):
        if self.executing and not cu.running:
            self.state = State.executing
            cu.SetPC(int(self.entry_addr.get_text(), 16))
-           thread = Thread(target=execute)
-           thread.start()
-           thread1 = Thread(target=self.on_executing)
-           thread1.daemon = True
-           thread1.start()
+           self.entry_addr.set_text("----")
+           self.entry_hex.set_text("--")
+           self.pc_text.set_text("PC: ---- ")
+           self.sp_text.set_text("SP: ---- ")
+           self.flags_text.set_text("FLAGS: -------- ")
+           cu.SetBreakpoints(self.BreakpointAddresses())
+           cu.SetCompletionHandler(self.on_completed)
+           cu.Start()
+           self.lastSnapshot = None
+           cu.RequestSnapshot(None, 1)
+           self.refresher = GLib.timeout_add(1000 // refresh_rate, self.refresh)
+
+    def refresh(self):
+        if not cu.running:
+            self.refresher = None
+            return False
+        snapshot = cu.snapshot
+        cu.RequestSnapshot(None, 1)
+        self.memview.Refresh()
+        if snapshot is None or snapshot[:3] == self.lastSnapshot:
+            return True
+        self.lastSnapshot = snapshot[:3]
+        regs, addr, memory, steps, cycles = snapshot
+        self.entry_addr.set_text('{:04x}'.format(addr))
+        self.entry_hex.set_text('{:02x}'.format(memory[0]).upper() if memory else "--")
+        self.pc_text.set_text('PC: ' + '{:04x}'.format(regs[9]))
+        self.sp_text.set_text('SP: ' + '{:04x}'.format(regs[8]))
+        self.flags_text.set_text('FLAGS: ' + '{:08b}'.format(regs[7]))
+        return True
 
     def SingleStep(self):
         global cu
@@ -580,28 +624,117 @@ class Window(Gtk.Window):
                 self.change_data()
                 return
             cu.SetPC(int(self.entry_addr.get_text(), 16))
-            cu.SingleStep()
+            cu.Step()
             self.singleStepping = True
             self.entry_addr.set_text('{:04x}'.format(cu.GetPC()))
             self.change_data()
     
-    def on_executing(self):
-        Gdk.threads_enter()
-        self.entry_addr.set_text("----")
-        self.entry_hex.set_text("--")
-        self.pc_text.set_text("PC: ---- ")
-        self.sp_text.set_text("SP: ---- ")
-        self.flags_text.set_text("FLAGS: -------- ")
-        Gdk.threads_leave()
-        while cu.running:
-            pass
-        Gdk.threads_enter()
-        self.reset(False)
+    def StepBack(self):
+        # Also works after a run ends, since the post-run reset keeps the history
+        if cu.running:
+            return
+        if not cu.history.StepBack():
+            print("No earlier state recorded")
+            return
+        self.ShowRewound()
+
+    def run_back_button(self, w):
+        # Goes back to the previous time a gutter breakpoint was reached
+        if cu.running:
+            return
+        if not cu.history.CanStepBack():
+            print("No earlier state recorded")
+            return
+        self.Clear()
+        if cu.history.RunBack(set(self.BreakpointAddresses())):
+            self.on_breakpoint(cu.GetPC())
+        else:
+            print("No earlier breakpoint; at the oldest recorded state")
+        self.ShowRewound()
+
+    def ShowRewound(self):
+        self.state = State.go
+        self.executing = True
+        self.singleStepping = True
+        self.entry_addr.set_text('{:04x}'.format(cu.GetPC()))
+        self.memview.Refresh()
+        self.change_data()
+
+    def real_speed(self, w):
+        cu.SetClockRate(3000000 if w.get_active() else None)
+
+    def on_completed(self, error):
+        # Called from the CU thread; hand over to the GTK main loop
+        GLib.idle_add(self.on_executed, error)
+
+    def on_executed(self, error):
+        if self.refresher is not None:
+            GLib.source_remove(self.refresher)
+            self.refresher = None
+        if error:
+            self.Clear()
+            print()
+            print ("Error: ")
+            print ("=======")
+            print(error)
+            pc = cu.instrPC
+            if self.session.asm is not None:
+                print("\tat: " + self.session.asm.Index().Describe(pc))
+            else:
+                print("\tat address: " + hex(pc))
+            print()
+        elif cu.breakAt is not None:
+            self.on_breakpoint(cu.breakAt)
+            return False
+        self.reset(False, keepHistory=True)
         self.executing = True
         self.entry_addr.set_text('{:04x}'.format(cu.GetPC()))
         self.change_data()
         self.executing = False
-        Gdk.threads_leave()
+        return False
+
+    def on_breakpoint(self, pc):
+        # Stays in Go state so Exec continues and Single step steps from here
+        self.Clear()
+        if self.session.asm is not None:
+            print("Breakpoint at: " + self.session.asm.Index().Describe(pc))
+            entry = self.session.asm.Index().Lookup(pc)
+            if entry is not None and entry["file"] is None:
+                tb = self.textEditor.get_buffer()
+                tb.place_cursor(tb.get_iter_at_line(entry["line_no"] - 1))
+                self.textEditor.scroll_to_mark(tb.get_insert(), 0.1, False, 0, 0)
+        else:
+            print("Breakpoint at: " + hex(pc))
+        self.state = State.go
+        self.executing = True
+        self.singleStepping = True
+        self.entry_addr.set_text('{:04x}'.format(pc))
+        self.change_data()
+
+    def toggle_breakpoint(self, view, iter, event):
+        tb = view.get_buffer()
+        line = iter.get_line()
+        if tb.get_source_marks_at_line(line, "breakpoint"):
+            tb.remove_source_marks(tb.get_iter_at_line(line), tb.get_iter_at_line(line), "breakpoint")
+        else:
+            tb.create_source_mark(None, "breakpoint", tb.get_iter_at_line(line))
+
+    def BreakpointAddresses(self):
+        # Maps marked lines of the loaded program to the first address they assemble to
+        if self.session.asm is None:
+            return []
+        index = self.session.asm.Index()
+        tb = self.textEditor.get_buffer()
+        addrs = []
+        it = tb.get_start_iter()
+        if tb.get_source_marks_at_iter(it, "breakpoint") or tb.forward_iter_to_source_mark(it, "breakpoint"):
+            while True:
+                addr = index.LineAddress(it.get_line() + 1)
+                if addr is not None:
+                    addrs.append(addr)
+                if not tb.forward_iter_to_source_mark(it, "breakpoint"):
+                    break
+        return addrs
 
     def exam_mem(self):
         if self.state == State.executing:
@@ -626,11 +759,11 @@ class Window(Gtk.Window):
         self.change_data()
         self.entry_hex.set_editable(False)
 
-    def reset(self, resetAlu=True):
+    def reset(self, resetAlu=True, keepHistory=False):
         self.entry_hex.set_editable(False)
         self.executing = False
         self.entry_addr.grab_focus()
-        cu.Reset()
+        cu.Reset(keepHistory)
         time.sleep(0.02)
         if resetAlu and not self.state == State.executing:
             alu.Reset()
@@ -669,45 +802,46 @@ class Window(Gtk.Window):
         self.pc_text.set_text('PC: ' + '{:04x}'.format(alu.registers['PC']))
         self.sp_text.set_text('SP: ' + '{:04x}'.format(alu.registers['SP']))
         self.flags_text.set_text('FLAGS: ' + '{:08b}'.format(alu.registers['F']))
+        self.memview.Refresh()
 
-    def ExportDialog(self, withAsm = False):
+    def ExportDialog(self, withAsm = False, format = None):
         dialog = Gtk.FileChooserDialog("Export File", self, Gtk.FileChooserAction.SAVE, 
                                 (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL, Gtk.STOCK_SAVE, Gtk.ResponseType.OK))
-        dialog.set_current_name("untitled.asm")
+        dialog.set_current_name("untitled." + (format or "asm"))
         dialog.set_do_overwrite_confirmation(True)
         self.AddFilters(dialog)
         res = dialog.run()
         if res == Gtk.ResponseType.OK:
-            self.Export(dialog.get_filename(), withAsm)
+            self.Export(dialog.get_filename(), withAsm, format)
         elif res == Gtk.ResponseType.CANCEL:
             pass
         dialog.destroy()
         
-    def Export(self, filename, withAsm = False):
-        fp = open(filename, 'w')
+    def Export(self, filename, withAsm = False, format = None):
         tb = self.textEditor.get_buffer()
         string = tb.get_text(tb.get_start_iter(), tb.get_end_iter(), False)
-        asm = Assembler()
         try:
-            asm.Lex(string)
             try:
                 addr = int(self.loadaddr.get_text(), 16)
             except:
                 addr = 0
-            asm.Parse(addr)
-            for byte_list in asm.bytes_list:
-                ad = byte_list["address"]
-                i = 0
-                if withAsm:
-                    fp.write(byte_list["asm"] + "\t;")
-                else:
-                    fp.write('{:04x}'.format(ad)+": ")
-                for byte in byte_list["bytes"]:
-                    fp.write('{:02x}'.format(byte)+ " ")
-                    i += 1
-                if not withAsm:
-                    fp.write("\t\t;"+byte_list["asm"])
-                fp.write("\n")
+            asm = self.session.Assemble(string, addr)
+            if format == "hex":
+                with open(filename, 'w') as fp:
+                    asm.WriteHex(fp)
+            elif format == "bin":
+                with open(filename, 'wb') as fp:
+                    asm.WriteBinary(fp)
+            else:
+                lines = []
+                for byte_list in asm.bytes_list:
+                    codes = "".join('{:02x}'.format(byte) + " " for byte in byte_list["bytes"])
+                    if withAsm:
+                        lines.append(byte_list["asm"] + "\t;" + codes + "\n")
+                    else:
+                        lines.append('{:04x}'.format(byte_list["address"]) + ": " + codes + "\t\t;" + byte_list["asm"] + "\n")
+                with open(filename, 'w') as fp:
+                    fp.write("".join(lines))
             strlbl = ""
             for lbl in asm.labels:
                 strlbl += "\n" + lbl + " : " + hex(asm.labels[lbl])
@@ -721,11 +855,17 @@ class Window(Gtk.Window):
             print ("Assembling Error: ")
             print ("=======")
             print(ex)
-            print("at line: \n\t" + asm.line + "\nline no.: " + str(asm.line_no))
-        fp.close()
+            print("at line: \n\t" + self.session.line + "\nline no.: " + str(self.session.line_no) +
+                  (" in " + self.session.file if self.session.file else ""))
          
 
 import platform
+import argparse
+parser = argparse.ArgumentParser(description="8085 Emulator")
+parser.add_argument("--log", metavar="FILE", help="also append messages to FILE")
+args, unknown = parser.parse_known_args()
+logFile = open(args.log, 'a') if args.log else None
+
 GObject.threads_init()
 if platform.system() == 'Linux':
     Gdk.threads_init()
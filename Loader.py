@@ -0,0 +1,97 @@
+
+def CheckSegments(bus, segments):
+    segments = sorted(segments, key=lambda s: s[0])
+    lastEnd = -1
+    for addr, data in segments:
+        end = addr + len(data) - 1
+        if addr < 0 or end > 0xFFFF:
+            raise Exception("Segment out of address space: " + hex(addr) + " - " + hex(end))
+        if addr <= lastEnd:
+            raise Exception("Overlapping segments at: " + hex(addr))
+        if not bus.IsMapped(addr, len(data)):
+            raise Exception("Segment not mapped to memory: " + hex(addr) + " - " + hex(end))
+        lastEnd = max(lastEnd, end)
+    return segments
+
+def LoadSegments(bus, segments):
+    segments = CheckSegments(bus, segments)
+    for addr, data in segments:
+        bus.WriteBlock(addr, data)
+    return segments
+
+def LoadAssembler(bus, asm):
+    return LoadSegments(bus, asm.GetSegments())
+
+hex_record_size = 16
+
+def WriteHex(fp, segments, recordSize=hex_record_size):
+    lines = []
+    for addr, data in sorted(segments, key=lambda s: s[0]):
+        for offset in range(0, len(data), recordSize):
+            chunk = bytes(data[offset:offset+recordSize])
+            record = bytes([ len(chunk), ((addr+offset) >> 8) & 0xFF, (addr+offset) & 0xFF, 0x00 ]) + chunk
+            lines.append(":" + record.hex().upper() + '{:02X}'.format(-sum(record) & 0xFF) + "\n")
+    lines.append(":00000001FF\n")
+    fp.write("".join(lines))
+
+def ReadHex(fp):
+    segments = []
+    start = None
+    data = bytearray()
+    for lineno, line in enumerate(fp, 1):
+        if isinstance(line, bytes):
+            line = line.decode('ascii')
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] != ':':
+            raise Exception("Invalid Intel HEX record at line " + str(lineno))
+        record = bytes.fromhex(line[1:])
+        if len(record) < 5 or len(record) != record[0] + 5 or sum(record) & 0xFF:
+            raise Exception("Invalid Intel HEX record at line " + str(lineno))
+        kind = record[3]
+        if kind == 0x01:
+            break
+        if kind in (0x02, 0x04):
+            if any(record[4:-1]):
+                raise Exception("Intel HEX address beyond 64K at line " + str(lineno))
+            continue
+        if kind != 0x00:
+            continue
+        addr = (record[1] << 8) | record[2]
+        # Coalesce consecutive records so each run is loaded with one block write
+        if start is None or addr != start + len(data):
+            if start is not None:
+                segments.append((start, bytes(data)))
+            start = addr
+            data = bytearray()
+        data += record[4:-1]
+    if start is not None and data:
+        segments.append((start, bytes(data)))
+    return segments
+
+def WriteBinary(fp, segments, fill=0x00):
+    segments = sorted(segments, key=lambda s: s[0])
+    if not segments:
+        return None
+    base = segments[0][0]
+    end = max(addr + len(data) for addr, data in segments)
+    image = bytearray([ fill ]) * (end - base)
+    for addr, data in segments:
+        image[addr-base:addr-base+len(data)] = data
+    fp.write(image)
+    return base
+
+def IsIntelHex(data):
+    return data[:1] == b':' and not data.translate(None, b':0123456789ABCDEFabcdef \t\r\n')
+
+def LoadHex(bus, fp):
+    return LoadSegments(bus, ReadHex(fp))
+
+def LoadBinary(bus, fp, addr):
+    return LoadSegments(bus, [ (addr, fp.read()) ])
+
+def LoadImage(bus, data, addr):
+    if IsIntelHex(data):
+        return LoadSegments(bus, ReadHex(data.splitlines()))
+    return LoadSegments(bus, [ (addr, bytes(data)) ])
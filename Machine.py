@@ -0,0 +1,85 @@
+from ALU import ALU
+from CU import CU
+from RAM import RAM
+from Bus import Bus
+from PPI import PPI
+from Assembler import Assembler
+from Loader import LoadAssembler, LoadImage
+
+from functools import partial
+
+class Machine:
+    def __init__(self, ramBase=0x0, ramSizeInK=64):
+        self.bus = Bus()
+        self.ram = RAM(ramBase, ramSizeInK)
+        self.bus.AddMemoryPeripheral(self.ram, ramBase, ramBase+ramSizeInK*1024-1)
+
+        self.alu = ALU()
+        self.cu = CU(self.alu, self.bus)
+        self.ppis = []
+        self.asm = None
+        self.maxSteps = None
+
+    def AddPPI(self, addr):
+        ppi = PPI(addr)
+        self.bus.AddIOPeripheral(ppi, addr, addr+3)
+        ppi.SetInterruptCallPA(partial(self.cu.RST, 5.5, ppi))
+        ppi.SetInterruptCallPB(partial(self.cu.RST, 6.5, ppi))
+        self.ppis.append(ppi)
+        return ppi
+
+    def RemovePPI(self, ppi):
+        self.bus.RemoveIOPeripheral(ppi)
+        if ppi in self.ppis:
+            self.ppis.remove(ppi)
+
+    def Reset(self, clearMemory=False):
+        self.asm = None
+        if clearMemory:
+            self.ram.Fill(self.ram.baseAddr, self.ram.baseAddr+len(self.ram.data)-1)
+        for ppi in list(self.ppis):
+            self.RemovePPI(ppi)
+        self.alu.Reset()
+        self.cu.Reset()
+
+    def Assemble(self, source, addr=0x8000, includePath=()):
+        asm = Assembler(includePath=includePath)
+        self.asm = asm
+        asm.Lex(source)
+        asm.Parse(addr)
+        return asm
+
+    def Load(self, asm):
+        return LoadAssembler(self.bus, asm)
+
+    def LoadImage(self, data, addr=0x8000):
+        self.asm = None
+        return LoadImage(self.bus, data, addr)
+
+    def Run(self, addr, maxSteps=None, timeout=None):
+        self.cu.SetPC(addr)
+        self.cu.Run(maxSteps, timeout)
+        return self.Status(maxSteps)
+
+    def Start(self, addr, maxSteps=None, timeout=None):
+        self.cu.SetPC(addr)
+        self.maxSteps = maxSteps
+        return self.cu.Start(maxSteps, timeout)
+
+    def Wait(self, timeout=None):
+        if not self.cu.Wait(timeout):
+            return None
+        if self.cu.error:
+            raise self.cu.error
+        return self.Status(self.maxSteps)
+
+    def Status(self, maxSteps=None):
+        if self.cu.halted:
+            return "halted"
+        if self.cu.breakAt is not None:
+            return "breakpoint"
+        if self.cu.watchAt is not None:
+            return "watchpoint"
+        if maxSteps is not None and self.cu.steps >= maxSteps:
+            return "step-limit"
+        return "timeout"
@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+from gi.repository import Gtk, Gdk
+
+bytes_per_row = 16
+total_rows = 0x10000 // bytes_per_row
+
+class MemoryView(Gtk.Box):
+    def __init__(self, bus):
+        Gtk.Box.__init__(self, spacing=0)
+        self.bus = bus
+        self.rows = {}
+        self.cursor = None
+        self.nibble = 0
+        self.charWidth = 8
+        self.rowHeight = 16
+        self.ascent = 12
+
+        self.adjustment = Gtk.Adjustment(value=0, lower=0, upper=total_rows, step_increment=1,
+                                         page_increment=16, page_size=16)
+        self.adjustment.connect('value-changed', self.on_scroll)
+
+        self.drawing_area = Gtk.DrawingArea()
+        self.drawing_area.set_size_request(600, 160)
+        self.drawing_area.set_can_focus(True)
+        self.drawing_area.add_events(Gdk.EventMask.BUTTON_PRESS_MASK | Gdk.EventMask.KEY_PRESS_MASK |
+                                     Gdk.EventMask.SCROLL_MASK)
+        self.drawing_area.connect('draw', self.expose_handler)
+        self.drawing_area.connect('size-allocate', self.on_resize)
+        self.drawing_area.connect('button-press-event', self.on_click)
+        self.drawing_area.connect('key-press-event', self.on_key)
+        self.drawing_area.connect('scroll-event', self.on_wheel)
+
+        scrollbar = Gtk.Scrollbar(orientation=Gtk.Orientation.VERTICAL, adjustment=self.adjustment)
+        self.pack_start(self.drawing_area, True, True, 0)
+        self.pack_start(scrollbar, False, True, 0)
+
+    def FirstRow(self):
+        return int(self.adjustment.get_value())
+
+    def VisibleRows(self):
+        return max(1, int(self.adjustment.get_page_size()))
+
+    def ReadRows(self, first, count):
+        count = min(count, total_rows - first)
+        try:
+            data = self.bus.ReadBlock(first * bytes_per_row, count * bytes_per_row)
+            return { first+i: data[i*bytes_per_row:(i+1)*bytes_per_row] for i in range(count) }
+        except Exception:
+            pass
+        # Part of the range is unmapped; fall back to row by row
+        rows = {}
+        for row in range(first, first+count):
+            try:
+                rows[row] = self.bus.ReadBlock(row * bytes_per_row, bytes_per_row)
+            except Exception:
+                rows[row] = None
+        return rows
+
+    def Refresh(self):
+        first = self.FirstRow()
+        rows = self.ReadRows(first, self.VisibleRows())
+        width = self.drawing_area.get_allocated_width()
+        for row, data in rows.items():
+            if self.rows.get(row, b'') != data:
+                self.drawing_area.queue_draw_area(0, (row - first) * self.rowHeight, width, self.rowHeight)
+        self.rows = rows
+
+    def ScrollTo(self, addr):
+        row = (addr & 0xFFFF) // bytes_per_row
+        first = self.FirstRow()
+        if row < first or row >= first + self.VisibleRows():
+            self.adjustment.set_value(min(row, total_rows - self.VisibleRows()))
+        self.cursor = addr & 0xFFFF
+        self.nibble = 0
+        self.drawing_area.queue_draw()
+
+    def on_scroll(self, adjustment):
+        self.rows = self.ReadRows(self.FirstRow(), self.VisibleRows())
+        self.drawing_area.queue_draw()
+
+    def on_resize(self, widget, allocation):
+        self.adjustment.set_page_size(max(1, allocation.height // self.rowHeight))
+        self.adjustment.set_page_increment(self.adjustment.get_page_size())
+        self.rows = self.ReadRows(self.FirstRow(), self.VisibleRows())
+
+    def on_wheel(self, widget, event):
+        step = 3
+        if event.direction == Gdk.ScrollDirection.UP:
+            self.Scroll(-step)
+        elif event.direction == Gdk.ScrollDirection.DOWN:
+            self.Scroll(step)
+        elif event.direction == Gdk.ScrollDirection.SMOOTH:
+            self.Scroll(int(round(event.delta_y * step)))
+        return True
+
+    def Scroll(self, rows):
+        value = self.FirstRow() + rows
+        self.adjustment.set_value(max(0, min(value, total_rows - self.VisibleRows())))
+
+    def expose_handler(self, widget, cr):
+        cr.select_font_face("monospace")
+        cr.set_font_size(12)
+        ascent, descent, height, max_x_advance, max_y_advance = cr.font_extents()
+        self.charWidth = max_x_advance
+        self.ascent = ascent
+        if int(height) + 2 != self.rowHeight:
+            self.rowHeight = int(height) + 2
+            self.adjustment.set_page_size(max(1, widget.get_allocated_height() // self.rowHeight))
+
+        first = self.FirstRow()
+        count = min(self.VisibleRows() + 1, total_rows - first)
+        missing = [ row for row in range(first, first+count) if row not in self.rows ]
+        if missing:
+            self.rows.update(self.ReadRows(missing[0], missing[-1] - missing[0] + 1))
+
+        x1, y1, x2, y2 = cr.clip_extents()
+        for i in range(count):
+            top = i * self.rowHeight
+            if top + self.rowHeight < y1 or top > y2:
+                continue
+            self.DrawRow(cr, first + i, top)
+
+    def DrawRow(self, cr, row, top):
+        addr = row * bytes_per_row
+        data = self.rows.get(row)
+        baseline = top + self.ascent + 1
+        cr.set_source_rgb(0.4, 0.4, 0.4)
+        cr.move_to(0, baseline)
+        cr.show_text('{:04X}:'.format(addr))
+        for i in range(bytes_per_row):
+            x = (6 + 3*i) * self.charWidth
+            if self.cursor == addr + i:
+                cr.set_source_rgb(0.7, 0.85, 1)
+                cr.rectangle(x, top, 2 * self.charWidth, self.rowHeight)
+                cr.fill()
+            cr.set_source_rgb(0, 0, 0)
+            cr.move_to(x, baseline)
+            cr.show_text('{:02X}'.format(data[i]) if data else '--')
+        if data:
+            text = "".join(chr(b) if 0x20 <= b < 0x7F else '.' for b in data)
+            cr.set_source_rgb(0.4, 0.4, 0.4)
+            cr.move_to((7 + 3*bytes_per_row) * self.charWidth, baseline)
+            cr.show_text(text)
+
+    def on_click(self, widget, event):
+        widget.grab_focus()
+        row = self.FirstRow() + int(event.y // self.rowHeight)
+        column = int((event.x / self.charWidth - 6) // 3)
+        if row < total_rows and 0 <= column < bytes_per_row:
+            self.cursor = row * bytes_per_row + column
+            self.nibble = 0
+            widget.queue_draw()
+        return True
+
+    def on_key(self, widget, event):
+        if self.cursor is None:
+            return False
+        moves = { Gdk.KEY_Left:-1, Gdk.KEY_Right:1, Gdk.KEY_Up:-bytes_per_row, Gdk.KEY_Down:bytes_per_row,
+                  Gdk.KEY_Page_Up:-bytes_per_row*self.VisibleRows(), Gdk.KEY_Page_Down:bytes_per_row*self.VisibleRows() }
+        if event.keyval in moves:
+            self.ScrollTo(max(0, min(self.cursor + moves[event.keyval], 0xFFFF)))
+            return True
+        key = chr(Gdk.keyval_to_unicode(event.keyval) or 0x20)
+        if key not in "0123456789abcdefABCDEF":
+            return False
+        try:
+            value = self.bus.PeekMemory(self.cursor)
+        except Exception:
+            return True
+        digit = int(key, 16)
+        if self.nibble == 0:
+            value = (digit << 4) | (value & 0x0F)
+        else:
+            value = (value & 0xF0) | digit
+        self.bus.WriteMemory(self.cursor, value)
+        if self.nibble == 0:
+            self.nibble = 1
+            self.Refresh()
+        else:
+            self.Refresh()
+            self.ScrollTo(min(self.cursor + 1, 0xFFFF))
+        return True
+
+
+if __name__ == "__main__":
+    from Machine import Machine
+    machine = Machine()
+    win = Gtk.Window(title="Memory")
+    win.add(MemoryView(machine.bus))
+    win.connect("delete-event", Gtk.main_quit)
+    win.show_all()
+    Gtk.main()
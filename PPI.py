@@ -11,6 +11,13 @@ class PPI:
 
         self.changedHandler = None
 
+    def Snapshot(self, previous=None):
+        return (self.cr, self.a, self.b, self.c)
+
+    def Restore(self, state):
+        self.cr, self.a, self.b, self.c = state
+        self.Change()
+
     def Change(self):
         if self.changedHandler:
             self.changedHandler()
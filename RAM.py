@@ -1,8 +1,11 @@
 
+page_size = 0x100
+
 class RAM:
     def __init__(self, baseAddr, sizeInK):
         self.baseAddr = baseAddr
-        self.data = [0]*sizeInK*1024
+        self.data = bytearray(sizeInK*1024)
+        self.view = memoryview(self.data)
 
     def Read(self, addr):
         return self.data[addr-self.baseAddr]
@@ -10,6 +13,39 @@ class RAM:
     def Write(self, addr, data):
         self.data[addr-self.baseAddr] = data
 
+    def CheckRange(self, addr, length):
+        offset = addr - self.baseAddr
+        if offset < 0 or length < 0 or offset + length > len(self.data):
+            raise Exception("Invalid address range: " + hex(addr) + " - " + hex(addr+length-1))
+        return offset
+
+    def ReadBlock(self, addr, length):
+        offset = self.CheckRange(addr, length)
+        return bytes(self.view[offset:offset+length])
+
+    def WriteBlock(self, addr, data):
+        offset = self.CheckRange(addr, len(data))
+        self.view[offset:offset+len(data)] = data
+
+    def Snapshot(self, previous=None):
+        # Pages equal to the previous snapshot's are shared with it, so a
+        # snapshot only copies the pages written since
+        pages = []
+        for i, offset in enumerate(range(0, len(self.data), page_size)):
+            page = self.view[offset:offset+page_size]
+            if previous is not None and previous[i] == page:
+                pages.append(previous[i])
+            else:
+                pages.append(bytes(page))
+        return tuple(pages)
+
+    def Restore(self, pages):
+        self.view[:] = b"".join(pages)
+
+    def Fill(self, start, end, value=0):
+        offset = self.CheckRange(start, end-start+1)
+        self.view[offset:offset+end-start+1] = bytes([value]) * (end-start+1)
+
 
     def Show(self):
         addr = self.baseAddr
@@ -20,7 +56,6 @@ class RAM:
 
     def ShowRange(self, start, end):
         addr = start
-        while addr <= end:
-            print(hex(addr)+": "+hex(self.Read(addr)))
+        for i in self.ReadBlock(start, end-start+1):
+            print(hex(addr)+": "+hex(i))
             addr+=1
-
@@ -0,0 +1,103 @@
+from collections import deque
+
+######
+# Reverse execution: the CU takes a snapshot every snapshot_interval
+# cycles, and going back restores the nearest earlier snapshot and
+# re-executes forward to the wanted instruction.
+#
+# Memory devices share unchanged pages with the previous snapshot, so each
+# snapshot costs the pages written since the last one rather than the
+# whole address space. Interrupts raised from outside the program (PPI
+# strobes, TRAP buttons) are not recorded and are not replayed.
+#####
+
+snapshot_interval = 100000
+max_snapshots = 1000
+
+class History:
+    def __init__(self, cu, interval=snapshot_interval, limit=max_snapshots):
+        self.cu = cu
+        self.interval = interval
+        # (position, CU state, ((device, state), ...)) oldest first
+        self.snapshots = deque(maxlen=limit)
+        self.nextCycles = 0
+
+    def Clear(self):
+        self.snapshots.clear()
+        self.nextCycles = 0
+
+    def Devices(self):
+        bus = self.cu.bus
+        return [ p for p in list(bus.mem_peripherals) + list(bus.io_peripherals) if hasattr(p, 'Snapshot') ]
+
+    def Take(self):
+        cu = self.cu
+        position = cu.Position()
+        previous = {}
+        if self.snapshots:
+            previous = dict(self.snapshots[-1][2])
+            if self.snapshots[-1][0] == position:
+                # Memory may have been edited since; the newer state wins
+                self.snapshots.pop()
+        devices = tuple((p, p.Snapshot(previous.get(p))) for p in self.Devices())
+        self.snapshots.append((position, cu.SaveState(), devices))
+        self.nextCycles = cu.cycles + self.interval
+
+    def Restore(self, snapshot):
+        position, state, devices = snapshot
+        cu = self.cu
+        cu.RestoreState(state)
+        for device, saved in devices:
+            device.Restore(saved)
+        cu.FlushBlocks()
+        cu.SetPosition(position)
+        self.nextCycles = cu.cycles + self.interval
+
+    def Replay(self, count):
+        cu = self.cu
+        position = cu.Position()
+        for i in range(count):
+            cu.SingleStep()
+        cu.SetPosition(position + count)
+
+    def Seek(self, position):
+        # Moves to the state after position instructions; later snapshots
+        # are dropped since execution may take a different path from here
+        while self.snapshots and self.snapshots[-1][0] > position:
+            self.snapshots.pop()
+        if not self.snapshots:
+            return False
+        snapshot = self.snapshots[-1]
+        self.Restore(snapshot)
+        self.Replay(position - snapshot[0])
+        return True
+
+    def CanStepBack(self):
+        return bool(self.snapshots) and self.snapshots[0][0] < self.cu.Position()
+
+    def StepBack(self):
+        if not self.CanStepBack():
+            return False
+        return self.Seek(self.cu.Position() - 1)
+
+    def RunBack(self, breakpoints):
+        # Goes back to the last time PC reached a breakpoint before the
+        # current instruction, or to the oldest snapshot if it never did
+        if not self.CanStepBack():
+            return False
+        cu = self.cu
+        target = cu.Position()
+        for snapshot in reversed(list(self.snapshots)):
+            if snapshot[0] >= target:
+                continue
+            self.Restore(snapshot)
+            hit = None
+            for position in range(snapshot[0], target):
+                if cu.regs.PC in breakpoints:
+                    hit = position
+                cu.SingleStep()
+            if hit is not None:
+                return self.Seek(hit)
+            target = snapshot[0]
+        self.Seek(self.snapshots[0][0])
+        return False
@@ -0,0 +1,165 @@
+from array import array
+import struct
+import sys
+
+######
+# Execution trace: one record per instruction in preallocated ring buffers.
+# Accepting an interrupt gets a record of its own, holding the vector as
+# its PC and the pushed return address as its writes.
+#
+# A trace file is the magic header followed by chunks. Each chunk is a
+# little-endian record count and then one column per field, in the order
+# of trace_columns.
+#####
+
+trace_magic = b"T8085\x02"
+trace_capacity = 1 << 20
+no_write = 0xFFFFFFFF
+# No instruction writes more than two bytes (PUSH, CALL, RST, SHLD, XTHL)
+max_writes = 2
+
+# Record kinds
+step_record = 0
+interrupt_record = 1
+
+# name, bytes per item, items per record
+trace_columns = [ ("kind", 1, 1), ("pc", 2, 1), ("size", 1, 1), ("ops", 1, 3), ("a", 1, 1), ("f", 1, 1),
+                  ("writeAddr", 4, max_writes), ("writeValue", 1, max_writes), ("cycles", 8, 1) ]
+
+def NewColumn(itemSize, count):
+    # Typecode widths are platform dependent, so pick one by size
+    for code in 'BHILQ':
+        if array(code).itemsize == itemSize:
+            return array(code, bytes(itemSize * count))
+    raise Exception("No array type of " + str(itemSize) + " bytes")
+
+class Tracer:
+    def __init__(self, bus, sizes, capacity=trace_capacity, stream=None):
+        self.bus = bus
+        self.sizes = sizes
+        self.capacity = capacity
+        self.stream = stream
+        self.count = 0
+        self.flushed = 0
+        self.writes = []
+        self.columns = { name:NewColumn(size, capacity * width) for name, size, width in trace_columns }
+        if stream is not None:
+            stream.write(trace_magic)
+
+    def Write(self, addr, value):
+        if len(self.writes) < max_writes:
+            self.writes.append((addr, value))
+
+    def Begin(self, pc):
+        # Called before the instruction runs, so self-modifying code is
+        # recorded with the bytes that were executed
+        self.writes = []
+        i = self.count % self.capacity
+        columns = self.columns
+        columns["kind"][i] = step_record
+        columns["pc"][i] = pc
+        op = self.bus.PeekMemory(pc)
+        size = self.sizes[op]
+        columns["size"][i] = size
+        ops = columns["ops"]
+        ops[3*i] = op
+        for k in range(1, size):
+            ops[3*i+k] = self.bus.PeekMemory((pc + k) & 0xFFFF)
+
+    def Interrupt(self, vector):
+        # Starts the record of an accepted interrupt; Record completes it
+        i = self.count % self.capacity
+        columns = self.columns
+        columns["kind"][i] = interrupt_record
+        columns["pc"][i] = vector
+        columns["size"][i] = 0
+
+    def Record(self, a, f, cycles):
+        i = self.count % self.capacity
+        columns = self.columns
+        columns["a"][i] = a
+        columns["f"][i] = f
+        writeAddr = columns["writeAddr"]
+        writeValue = columns["writeValue"]
+        for k in range(max_writes):
+            if k < len(self.writes):
+                writeAddr[max_writes*i+k], writeValue[max_writes*i+k] = self.writes[k]
+            else:
+                writeAddr[max_writes*i+k] = no_write
+        self.writes = []
+        columns["cycles"][i] = cycles
+        self.count += 1
+        if self.stream is not None and self.count - self.flushed >= self.capacity:
+            self.Flush()
+
+    def Flush(self):
+        # Writes the records not written yet; records overwritten before a
+        # flush are lost, which only happens without a stream
+        if self.stream is None:
+            return
+        first = max(self.flushed, self.count - self.capacity)
+        while first < self.count:
+            start = first % self.capacity
+            end = min(self.capacity, start + self.count - first)
+            self.WriteChunk(start, end)
+            first += end - start
+        self.flushed = self.count
+        self.stream.flush()
+
+    def WriteChunk(self, start, end):
+        parts = [ struct.pack("<I", end - start) ]
+        for name, size, width in trace_columns:
+            column = self.columns[name][start*width:end*width]
+            if sys.byteorder == 'big':
+                column.byteswap()
+            parts.append(column.tobytes())
+        self.stream.write(b"".join(parts))
+
+    def Entries(self):
+        # Records still held in memory, oldest first
+        for n in range(max(0, self.count - self.capacity), self.count):
+            yield self.Entry(n % self.capacity)
+
+    def Entry(self, i):
+        return MakeEntry(self.columns, i)
+
+
+def MakeEntry(columns, i):
+    # (pc, opcode bytes, A, F, ((write address, value), ...), cycles, interrupt)
+    size = columns["size"][i]
+    writes = tuple((columns["writeAddr"][max_writes*i+k], columns["writeValue"][max_writes*i+k])
+                   for k in range(max_writes) if columns["writeAddr"][max_writes*i+k] != no_write)
+    return (columns["pc"][i], bytes(columns["ops"][3*i:3*i+size]), columns["a"][i], columns["f"][i],
+            writes, columns["cycles"][i], columns["kind"][i] == interrupt_record)
+
+def ReadTrace(fp):
+    # Yields entries in the same form as Tracer.Entries
+    if fp.read(len(trace_magic)) != trace_magic:
+        raise Exception("Not a trace file")
+    while True:
+        header = fp.read(4)
+        if len(header) < 4:
+            return
+        count = struct.unpack("<I", header)[0]
+        columns = {}
+        for name, size, width in trace_columns:
+            column = NewColumn(size, 0)
+            column.frombytes(fp.read(size * width * count))
+            if sys.byteorder == 'big':
+                column.byteswap()
+            columns[name] = column
+        for i in range(count):
+            yield MakeEntry(columns, i)
+
+def FormatEntry(entry):
+    pc, ops, a, f, writes, cycles, interrupt = entry
+    text = '{:04X}  {:<8}  A={:02X} F={:02X}'.format(pc, "INT" if interrupt else ops.hex().upper(), a, f)
+    for addr, value in writes:
+        text += '  [{:04X}]={:02X}'.format(addr, value)
+    return text + '  @' + str(cycles)
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1], 'rb') as fp:
+        for entry in ReadTrace(fp):
+            print(FormatEntry(entry))